@@ -1,37 +1,47 @@
-import pandas as pd
-
 import sys
-from tqdm.auto import tqdm
+import importlib
 
 import propp_fr
 # Patch sys.modules to redirect references to 'propp_fr' to 'propp_fr'
 sys.modules['propp_fr'] = propp_fr
 
-from .propp_fr_load_save_functions import load_sacr_file, load_text_file, save_text_file, load_tokens_df, save_tokens_df, load_entities_df, save_entities_df, clean_text, load_book_file, save_book_file
-from .propp_fr_add_entities_features import add_features_to_entities
-from .propp_fr_generate_tokens_df import load_spacy_model, generate_tokens_df
-from .propp_fr_generate_tokens_and_entities_from_sacr import generate_tokens_and_entities_from_sacr
-from .propp_fr_generate_tokens_embeddings_tensor import load_tokenizer_and_embedding_model, get_embedding_tensor_from_tokens_df
-from .propp_fr_mentions_detection_module import mentions_detection_LOOCV_full_model_training, generate_NER_model_card_from_LOOCV_directory, load_mentions_detection_model, generate_entities_df
-from .propp_fr_mentions_detection_module import LockedDropout, Highway, NERModel
-
-from .propp_fr_coreference_resolution_module import coreference_resolution_LOOCV_full_model_training, generate_coref_model_card_from_LOOCV_directory
-from .propp_fr_coreference_resolution_module import load_coreference_resolution_model, perform_coreference, CoreferenceResolutionModel
+# Submodules are imported lazily, the first time one of their functions is accessed (PEP 562),
+# so that e.g. `from propp_fr import load_entities_df` does not pull in torch, transformers or spaCy.
+LAZY_ATTRIBUTES = {
+    ".propp_fr_load_save_functions": ["load_sacr_file", "load_text_file", "save_text_file", "load_tokens_df", "save_tokens_df", "load_entities_df", "save_entities_df", "clean_text", "load_book_file", "save_book_file"],
+    ".propp_fr_add_entities_features": ["add_features_to_entities"],
+    ".propp_fr_generate_tokens_df": ["load_spacy_model", "generate_tokens_df"],
+    ".propp_fr_generate_tokens_and_entities_from_sacr": ["generate_tokens_and_entities_from_sacr"],
+    ".propp_fr_generate_tokens_embeddings_tensor": ["load_tokenizer_and_embedding_model", "get_embedding_tensor_from_tokens_df", "TokensEmbeddingsStore", "TokensEmbeddingsProvider"],
+    ".propp_fr_mentions_detection_module": ["mentions_detection_LOOCV_full_model_training", "generate_NER_model_card_from_LOOCV_directory", "load_mentions_detection_model", "generate_entities_df",
+                                            "LockedDropout", "Highway", "NERModel"],
 
-from .propp_fr_extract_attributes import extract_attributes
-from .propp_fr_generate_characters_dict import generate_characters_dict
+    ".propp_fr_coreference_resolution_module": ["coreference_resolution_LOOCV_full_model_training", "generate_coref_model_card_from_LOOCV_directory",
+                                                "load_coreference_resolution_model", "perform_coreference", "CoreferenceResolutionModel"],
 
-from .propp_fr_generate_sacr_file import generate_sacr_file
+    ".propp_fr_extract_attributes": ["extract_attributes"],
+    ".propp_fr_generate_characters_dict": ["generate_characters_dict"],
 
-from .propp_fr_single_line_command import process_text_file, load_models
+    ".propp_fr_generate_sacr_file": ["generate_sacr_file"],
 
-from .propp_fr_generate_character_network import generate_character_network
+    ".propp_fr_single_line_command": ["process_text_file", "process_directory", "load_models"],
 
-from .propp_fr_classify_attributes import load_ontology_classification_model, classify_attributes
+    ".propp_fr_generate_character_network": ["generate_character_network"],
 
-# Inside propp_fr/__init__.py
-print("propp_fr package loaded successfully.")
+    ".propp_fr_classify_attributes": ["load_ontology_classification_model", "classify_attributes"],
 
+    ".propp_fr_benchmark_embedding_inference": ["benchmark_embedding_inference_modes"],
+}
+ATTRIBUTE_MODULES = {attribute: module_name for module_name, attributes in LAZY_ATTRIBUTES.items() for attribute in attributes}
 
+__all__ = list(ATTRIBUTE_MODULES)
 
+def __getattr__(name):
+    if name not in ATTRIBUTE_MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(ATTRIBUTE_MODULES[name], __name__), name)
+    globals()[name] = value  # Cache it, __getattr__ is only called for missing attributes
+    return value
 
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
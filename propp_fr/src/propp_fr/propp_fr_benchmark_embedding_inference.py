@@ -0,0 +1,127 @@
+import os
+import time
+import pandas as pd
+import torch
+from tabulate import tabulate
+
+from .propp_fr_load_save_functions import load_text_file, load_tokens_df
+from .propp_fr_generate_tokens_embeddings_tensor import load_tokenizer_and_embedding_model, get_embedding_tensor_from_tokens_df
+from .propp_fr_mentions_detection_module import generate_entities_df
+from .propp_fr_add_entities_features import add_features_to_entities
+from .propp_fr_coreference_resolution_module import perform_coreference
+
+# Propp_fr - Benchmark of the reduced-precision encoder inference modes against the float32 baseline
+
+def get_mentions_f1(reference_entities_df, entities_df):
+    reference_mentions = set(map(tuple, reference_entities_df[["start_token", "end_token", "cat"]].values.tolist()))
+    mentions = set(map(tuple, entities_df[["start_token", "end_token", "cat"]].values.tolist()))
+    if len(reference_mentions) + len(mentions) == 0:
+        return 1.0
+    return 2 * len(reference_mentions & mentions) / (len(reference_mentions) + len(mentions))
+
+def get_B3_f1(reference_entities_df, entities_df, entity_types):
+    # B-cubed F1 over the mentions found by both runs, from the contingency table of their COREF clusters
+    columns = ["start_token", "end_token", "COREF"]
+    reference_entities_df = reference_entities_df[reference_entities_df["cat"].isin(entity_types)][columns]
+    entities_df = entities_df[entities_df["cat"].isin(entity_types)][columns]
+    shared_mentions_df = pd.merge(entities_df, reference_entities_df, on=["start_token", "end_token"], suffixes=("", "_reference"))
+    if len(shared_mentions_df) == 0:
+        return 1.0
+
+    contingency = shared_mentions_df.groupby(["COREF", "COREF_reference"]).size().rename("shared").reset_index()
+    contingency["cluster_size"] = contingency["COREF"].map(shared_mentions_df["COREF"].value_counts())
+    contingency["reference_cluster_size"] = contingency["COREF_reference"].map(shared_mentions_df["COREF_reference"].value_counts())
+    precision = (contingency["shared"] ** 2 / contingency["cluster_size"]).sum() / len(shared_mentions_df)
+    recall = (contingency["shared"] ** 2 / contingency["reference_cluster_size"]).sum() / len(shared_mentions_df)
+    return 2 * precision * recall / (precision + recall)
+
+def benchmark_embedding_inference_modes(files_directory,
+                                        mentions_detection_model,
+                                        coreference_resolution_model,
+                                        inference_modes=("float32", "bfloat16", "int8"),
+                                        embeddings_dtype="float16",
+                                        embedding_mini_batch=10,
+                                        mentions_detection_batch=12,
+                                        coreference_resolution_batch=50000,
+                                        max_files=None,
+                                        verbose=1):
+    """
+    Benchmark the encoder inference modes of load_tokenizer_and_embedding_model on already processed files.
+
+    files_directory must contain .txt and .tokens files (e.g. the output of process_directory). Each mode
+    embeds every file, then runs mentions detection and coreference resolution. The float32 mode (float32
+    storage) is the baseline; other modes store their token embeddings as embeddings_dtype.
+
+    Returns a DataFrame with, for each mode, the encoder throughput and speedup over float32, and the
+    mentions detection F1 and coreference B-cubed F1 of its outputs measured against the float32 outputs
+    (the F1 delta is the loss of agreement with full precision, 0 meaning identical outputs).
+    """
+    file_names = sorted(f.replace(".tokens", "") for f in os.listdir(files_directory) if f.endswith(".tokens"))
+    if max_files is not None:
+        file_names = file_names[:max_files]
+    inference_modes = ["float32"] + [inference_mode for inference_mode in inference_modes if inference_mode != "float32"]
+    if torch.cuda.is_available() and "int8" in inference_modes:
+        print("int8 dynamic quantization only runs on CPU, skipping the int8 inference mode.")
+        inference_modes.remove("int8")
+
+    files_data = [(load_text_file(file_name, files_directory), load_tokens_df(file_name, files_directory))
+                  for file_name in file_names]
+    tokens_count = sum(len(tokens_df) for _, tokens_df in files_data)
+
+    benchmark_rows = []
+    reference_entities_dfs = None
+    for inference_mode in inference_modes:
+        tokenizer, embedding_model = load_tokenizer_and_embedding_model(mentions_detection_model["base_model_name"],
+                                                                        inference_mode=inference_mode)
+        mode_embeddings_dtype = "float32" if inference_mode == "float32" else embeddings_dtype
+
+        encoder_seconds = 0
+        entities_dfs = []
+        for text, tokens_df in files_data:
+            start_time = time.perf_counter()
+            tokens_embedding_tensor = get_embedding_tensor_from_tokens_df(text, tokens_df, tokenizer, embedding_model,
+                                                                          mini_batch_size=embedding_mini_batch,
+                                                                          subword_pooling_strategy=mentions_detection_model["subword_pooling_strategy"],
+                                                                          embeddings_dtype=mode_embeddings_dtype,
+                                                                          verbose=0)
+            encoder_seconds += time.perf_counter() - start_time
+
+            entities_df = generate_entities_df(tokens_df, tokens_embedding_tensor, mentions_detection_model,
+                                               batch_size=mentions_detection_batch)
+            entities_df = add_features_to_entities(entities_df, tokens_df)
+            entities_df = perform_coreference(entities_df=entities_df,
+                                              tokens_embedding_tensor=tokens_embedding_tensor,
+                                              coreference_resolution_model=coreference_resolution_model,
+                                              batch_size=coreference_resolution_batch,
+                                              propagate_coref=True,
+                                              rule_based_postprocess=False,
+                                              verbose=0)
+            entities_dfs.append(entities_df)
+
+        del embedding_model
+        if reference_entities_dfs is None:
+            reference_entities_dfs = entities_dfs
+
+        # Micro-averaged over files: each file is weighted by its number of mentions
+        mentions_f1 = sum(get_mentions_f1(reference_df, df) * len(reference_df) for reference_df, df in zip(reference_entities_dfs, entities_dfs))
+        coref_f1 = sum(get_B3_f1(reference_df, df, coreference_resolution_model["entity_types"]) * len(reference_df) for reference_df, df in zip(reference_entities_dfs, entities_dfs))
+        reference_mentions_count = max(sum(len(reference_df) for reference_df in reference_entities_dfs), 1)
+
+        benchmark_rows.append({"inference_mode": inference_mode,
+                               "embeddings_dtype": mode_embeddings_dtype,
+                               "tokens": tokens_count,
+                               "encoder_seconds": round(encoder_seconds, 2),
+                               "encoder_tokens_per_second": round(tokens_count / encoder_seconds, 1) if encoder_seconds > 0 else 0,
+                               "NER_F1": round(mentions_f1 / reference_mentions_count, 4),
+                               "coref_B3_F1": round(coref_f1 / reference_mentions_count, 4)})
+
+    benchmark_df = pd.DataFrame(benchmark_rows)
+    baseline_tokens_per_second = benchmark_df["encoder_tokens_per_second"].iloc[0]
+    benchmark_df["speedup"] = (benchmark_df["encoder_tokens_per_second"] / baseline_tokens_per_second).round(2) if baseline_tokens_per_second > 0 else 0
+    benchmark_df["NER_F1_delta"] = (benchmark_df["NER_F1"] - 1).round(4)
+    benchmark_df["coref_B3_F1_delta"] = (benchmark_df["coref_B3_F1"] - 1).round(4)
+
+    if verbose:
+        print(tabulate(benchmark_df, headers="keys", tablefmt="github", showindex=False))
+
+    return benchmark_df
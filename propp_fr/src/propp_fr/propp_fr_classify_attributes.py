@@ -134,7 +134,7 @@ def classify_attributes(tokens_df, tokens_embedding_tensor: torch.Tensor, model_
         return tokens_df
 
     # -- build embedding slice --
-    attribute_embeddings = tokens_embedding_tensor[attribute_ids]  # (N, emb_dim)
+    attribute_embeddings = tokens_embedding_tensor[attribute_ids].to(dtype=torch.float32)  # (N, emb_dim), even from float16 storage
 
     # -- append syntactic role vector if the model was trained with it --
     expected_input_dim = next(model.net.parameters()).shape[1]
@@ -35,79 +35,68 @@ import subprocess
 from tabulate import tabulate
 import requests
 
-from propp_fr import load_tokenizer_and_embedding_model, get_embedding_tensor_from_tokens_df
+from propp_fr import load_tokenizer_and_embedding_model, get_embedding_tensor_from_tokens_df, TokensEmbeddingsStore
 from propp_fr import load_tokens_df, load_entities_df, load_text_file
 
 def get_tokens_embeddings_tensor_dict(tokens_embeddings_tensor_dict_path, model_name, files_directory,
                                       embedding_batch_size=10, subword_pooling_strategy="average",
+                                      embeddings_dtype="float32",
                                       verbose=1):
     """
-    Generate or load a dictionary containing contextual embeddings for each token in the documents.
+    Generate or load the contextual embeddings of each token in the documents.
+
+    Embeddings are kept in a memory-mapped TokensEmbeddingsStore, filled book by book, so that
+    an interrupted run resumes where it stopped and the embeddings are never all resident in RAM.
+    Pickled dictionaries (paths ending with .pkl) from previous versions are still loaded as is.
 
     Args:
-        tokens_embeddings_tensor_dict_path (str): Path to save/load the embeddings dictionary.
+        tokens_embeddings_tensor_dict_path (str): Directory of the embeddings store (or legacy .pkl file).
         model_name (str): Name of the embedding model to use.
         files_directory (str): Directory containing token files.
         embedding_batch_size (int, optional): Batch size for embedding generation. Default is 10.
+        embeddings_dtype (str, optional): "float32" or "float16" storage of new embeddings. Default is "float32".
 
     Returns:
-        dict: A dictionary where keys are file names and values are token embedding tensors.
+        TokensEmbeddingsStore: A dict-like store where keys are file names and values are token embedding tensors.
     """
-    # Check if the embeddings dictionary already exists
-    if not os.path.exists(tokens_embeddings_tensor_dict_path):
+    if tokens_embeddings_tensor_dict_path.endswith(".pkl") and os.path.exists(tokens_embeddings_tensor_dict_path):
+        with open(tokens_embeddings_tensor_dict_path, 'rb') as f:
+            tokens_embeddings_tensor_dict = pickle.load(f)
+        return tokens_embeddings_tensor_dict
+
+    tokens_embeddings_tensor_dict = TokensEmbeddingsStore(tokens_embeddings_tensor_dict_path, dtype=embeddings_dtype)
+
+    # Get all .tokens files in the directory that are not in the store yet
+    extension = ".tokens"
+    tokens_files = sorted([f.replace(extension, "") for f in os.listdir(files_directory) if f.endswith(extension)])
+    missing_files = [file_name for file_name in tokens_files if file_name not in tokens_embeddings_tensor_dict]
+
+    if missing_files:
         # Load tokenizer and embedding model
         tokenizer, embedding_model = load_tokenizer_and_embedding_model(model_name)
 
-        # Get all .tokens files in the directory
-        extension = ".tokens"
-        tokens_files = sorted([f.replace(extension, "") for f in os.listdir(files_directory) if f.endswith(extension)])
-
-        # Initialize dictionary to store embeddings
-        tokens_embeddings_tensor_dict = {}
-
-        # Generate embeddings for each file
-        if verbose == 1:
-            for file_name in tqdm(tokens_files, desc="Generating tokens embeddings", leave=False):
-                tokens_df = load_tokens_df(file_name, files_directory=files_directory, extension=extension)
-                text_content = load_text_file(file_name, files_directory=files_directory)
-
-                tokens_embedding_tensor = get_embedding_tensor_from_tokens_df(text_content, tokens_df,
-                                                                              tokenizer, embedding_model,
-                                                                              sliding_window_size='max',
-                                                                              mini_batch_size=embedding_batch_size,
-                                                                              sliding_window_overlap=0.5,
-                                                                              subword_pooling_strategy=subword_pooling_strategy,
-                                                                              )
-
-                # Store embeddings in the dictionary
-                tokens_embeddings_tensor_dict[file_name] = tokens_embedding_tensor
-        if verbose == 0:
-            for file_name in tokens_files:
-                tokens_df = load_tokens_df(file_name, files_directory=files_directory, extension=extension)
-                text_content = load_text_file(file_name, files_directory=files_directory)
-
-                tokens_embedding_tensor = get_embedding_tensor_from_tokens_df(text_content, tokens_df,
-                                                                              tokenizer, embedding_model,
-                                                                              sliding_window_size='max',
-                                                                              mini_batch_size=embedding_batch_size,
-                                                                              sliding_window_overlap=0.5,
-                                                                              subword_pooling_strategy=subword_pooling_strategy,
-                                                                              )
-
-                # Store embeddings in the dictionary
-                tokens_embeddings_tensor_dict[file_name] = tokens_embedding_tensor
-
-        # Save the generated embeddings dictionary to disk
-        with open(tokens_embeddings_tensor_dict_path, 'wb') as f:
-            pickle.dump(tokens_embeddings_tensor_dict, f)
-
-    else:  # if the tokens embeddings dict already exist
-        # Load the embeddings dictionary from disk
-        with open(tokens_embeddings_tensor_dict_path, 'rb') as f:
-            tokens_embeddings_tensor_dict = pickle.load(f)
+        # Generate embeddings for each file and append them to the store
+        for file_name in tqdm(missing_files, desc="Generating tokens embeddings", leave=False, disable=(verbose == 0)):
+            tokens_df = load_tokens_df(file_name, files_directory=files_directory, extension=extension)
+            text_content = load_text_file(file_name, files_directory=files_directory)
+
+            tokens_embedding_tensor = get_embedding_tensor_from_tokens_df(text_content, tokens_df,
+                                                                          tokenizer, embedding_model,
+                                                                          sliding_window_size='max',
+                                                                          mini_batch_size=embedding_batch_size,
+                                                                          sliding_window_overlap=0.5,
+                                                                          subword_pooling_strategy=subword_pooling_strategy,
+                                                                          )
+
+            tokens_embeddings_tensor_dict.append(file_name, tokens_embedding_tensor)
+
+        del embedding_model
+        gc.collect()
+        torch.cuda.empty_cache()
 
     return tokens_embeddings_tensor_dict
 
+
 def get_mentions_embeddings(entities_df, tokens_embeddings_tensor):
     """
     Generate a single embedding for each mention by averaging the first and last token embeddings.
@@ -129,7 +118,8 @@ def get_mentions_embeddings(entities_df, tokens_embeddings_tensor):
                                  tokens_embeddings_tensor[entity_end_token]]
 
         # Compute the mean of the first and last embeddings
-        mention_embedding = torch.mean(torch.stack(first_last_embeddings), dim=0)
+        # Token embeddings may be stored in float16, mentions embeddings are computed in float32
+        mention_embedding = torch.mean(torch.stack(first_last_embeddings).to(dtype=torch.float32), dim=0)
 
         # Instead concatenate first and last embeddings
         # mention_embedding = torch.cat(first_last_embeddings, dim=0)
@@ -418,6 +408,8 @@ def get_coreference_resolution_training_dict(files_directory,
 
     if not os.path.exists(coreference_resolution_training_dict_path):
         tokens_embeddings_tensor_dict_path = os.path.join(coref_trained_model_directory, "tokens_embeddings_tensor.pkl")
+        if not os.path.exists(tokens_embeddings_tensor_dict_path):
+            tokens_embeddings_tensor_dict_path = os.path.join(coref_trained_model_directory, "tokens_embeddings_store")
         tokens_embeddings_tensor_dict = get_tokens_embeddings_tensor_dict(tokens_embeddings_tensor_dict_path,
                                                                           model_name, files_directory,
                                                                           subword_pooling_strategy=subword_pooling_strategy,
@@ -430,7 +422,7 @@ def get_coreference_resolution_training_dict(files_directory,
             if entity_types:
                 CAT_entities_df = entities_df[entities_df["cat"].isin(entity_types)].copy().reset_index(drop=True)
 
-            tokens_embeddings_tensor = tokens_embeddings_tensor_dict[file_name]
+            tokens_embeddings_tensor = tokens_embeddings_tensor_dict[file_name].float()
             mentions_embeddings_tensor = get_mentions_embeddings(CAT_entities_df, tokens_embeddings_tensor)
 
             mention_pairs_df = initialize_mention_pairs_df(CAT_entities_df,
@@ -2734,6 +2726,7 @@ def perform_coreference(entities_df=None,
                         propagate_coref=False,
                         rule_based_postprocess=True,
                         characters_alias_list=None,
+                        mentions_embeddings_tensor=None,
                         verbose=1):
     """
     Perform coreference resolution on the given entities DataFrame.
@@ -2749,6 +2742,8 @@ def perform_coreference(entities_df=None,
         - "model": The trained coreference resolution model.
         - "mention_pairs_post_process": Post-processing configuration for mention pairs.
     - batch_size (int): Batch size for processing mention pairs during inference.
+    - mentions_embeddings_tensor (torch.Tensor, optional): Precomputed mention embeddings, one row per entity of
+        the coreference entity types, in entities_df order. If given, tokens_embedding_tensor is not used.
 
     Returns:
     - pd.DataFrame: Updated entities_df with a "COREF" column indicating cluster IDs.
@@ -2766,7 +2761,8 @@ def perform_coreference(entities_df=None,
     CAT_entities_df = entities_df[entities_df["cat"].isin(entity_types)].copy().reset_index(drop=True)
 
     # Step 1: Generate mention embeddings for the filtered entities
-    mentions_embeddings_tensor = get_mentions_embeddings(CAT_entities_df, tokens_embedding_tensor)
+    if mentions_embeddings_tensor is None:
+        mentions_embeddings_tensor = get_mentions_embeddings(CAT_entities_df, tokens_embedding_tensor)
     del tokens_embedding_tensor
     gc.collect()
 
@@ -1,3 +1,4 @@
+import pandas as pd
 from collections import Counter
 
 def gender_inference(gender_list):
@@ -88,7 +89,11 @@ def generate_characters_dict(tokens_df,
                             entities_df,
                             COREF_column='COREF',
                             min_occurrences=2):
-    tokens_df['lemma'] = tokens_df.copy()['lemma'].str.lower()
+    lowercased_lemma = tokens_df['lemma'].str.lower()
+    if isinstance(tokens_df['lemma'].dtype, pd.CategoricalDtype):
+        # Keep the compact schema of generate_tokens_df
+        lowercased_lemma = lowercased_lemma.astype('category')
+    tokens_df['lemma'] = lowercased_lemma
     tokens_df = tokens_df[
         ['token_ID_within_document', 'word', 'lemma', 'char_att_poss', 'char_att_agent', 'char_att_patient',
          'char_att_mod']]
@@ -2,9 +2,11 @@ import subprocess
 import sys
 from tqdm.auto import tqdm
 import gc
+import numpy as np
 import pandas as pd
 import torch
 import spacy
+from spacy.attrs import ORTH, LEMMA, POS, DEP, HEAD, IDX, IS_TITLE, IS_PUNCT, SENT_START, MORPH
 
 
 ## Get tokens_df from text_file
@@ -30,127 +32,259 @@ def load_spacy_model(model_name='fr_dep_news_trf', model_max_length=500000):
 
     return model
 
+TOKENS_DF_COLUMNS = ['paragraph_ID', 'sentence_ID', 'token_ID_within_sentence', 'token_ID_within_document', 'word',
+                     'lemma', 'byte_onset', 'byte_offset', 'POS_tag', 'dependency_relation', 'syntactic_head_ID', 'morph']
+SPACY_DOC_ATTRIBUTES = [ORTH, LEMMA, POS, DEP, HEAD, IDX, IS_TITLE, IS_PUNCT, SENT_START, MORPH]
+# Compact in-memory schema: int32 IDs and offsets, categoricals (i.e. an interned vocabulary) for the strings
+TOKENS_DF_INTEGER_COLUMNS = ['paragraph_ID', 'sentence_ID', 'token_ID_within_sentence', 'token_ID_within_document',
+                             'byte_onset', 'byte_offset', 'syntactic_head_ID']
+TOKENS_DF_CATEGORICAL_COLUMNS = ['word', 'lemma', 'POS_tag', 'dependency_relation', 'morph']
+
+def get_strings_from_hashes(hashes, string_store):
+    # Look up each distinct hash only once in the StringStore
+    unique_hashes, inverse_indices = np.unique(hashes, return_inverse=True)
+    unique_strings = np.array([string_store[int(string_hash)] for string_hash in unique_hashes], dtype=object)
+    return unique_strings, inverse_indices
+
+def get_compact_tokens_df(tokens_df):
+    compact_dtypes = {column: 'int32' for column in TOKENS_DF_INTEGER_COLUMNS if column in tokens_df.columns}
+    compact_dtypes.update({column: 'category' for column in TOKENS_DF_CATEGORICAL_COLUMNS if column in tokens_df.columns})
+    return tokens_df.astype(compact_dtypes)
+
 def generate_tokens_df_from_spacy_doc(doc):
-    token_dict = []
-    paragraph_ID = 0
-    sentence_ID = -1
-    previous_is_newline_char = True
-    previous_is_sent_start = False
-    previous_is_punct = False
-    token_ID_within_sentence = 0
-
-    for token in doc:
-        word = token.text
-        lemma = token.lemma_
-        token_ID_within_document = token.i
-        byte_onset = token.idx
-        byte_offset = token.idx + len(word)
-        is_newline_character = '\n' in token.text_with_ws
-        POS_tag = token.pos_
-        morph = token.morph
-        is_sent_start = token.is_sent_start
-        if previous_is_newline_char or ((
-                                                token.is_title or token.is_punct) and is_sent_start and previous_is_punct and not previous_is_sent_start):
-            is_sent_start = True
-        else:
-            is_sent_start = False
-        dependency_relation = token.dep_
-        syntactic_head_ID = token.head.i
-
-        if word in ['.', '!', '?']:
-            previous_is_punct = True
-        else:
-            previous_is_punct = False
-
-        if is_sent_start:
-            previous_is_sent_start = True
-            sentence_ID += 1
-            token_ID_within_sentence = 0
-        else:
-            previous_is_sent_start = False
-            token_ID_within_sentence += 1
-
-        if is_newline_character == True:
-            paragraph_ID += 1
-            previous_is_newline_char = True
-        else:
-            previous_is_newline_char = False
-            token_dict.append({'paragraph_ID': paragraph_ID,
-                               'sentence_ID': sentence_ID,
-                               'token_ID_within_sentence': token_ID_within_sentence,
-                               'token_ID_within_document': token_ID_within_document,
-                               'word': word,
-                               'lemma': lemma,
-                               'byte_onset': byte_onset,
-                               'byte_offset': byte_offset,
-                               'POS_tag': POS_tag,
-                               'dependency_relation': dependency_relation,
-                               'syntactic_head_ID': syntactic_head_ID,
-                               'morph': morph,
-                               })
-
-    tokens_df = pd.DataFrame(token_dict)
+    if len(doc) == 0:
+        return pd.DataFrame(columns=TOKENS_DF_COLUMNS)
+
+    doc_array = doc.to_array(SPACY_DOC_ATTRIBUTES)
+    orth, lemma, pos, dep, relative_head, idx, is_title, is_punct, spacy_sent_start, morph = doc_array.T
+    # HEAD (relative to the token) and SENT_START (-1, 0 or 1) are signed values stored as uint64
+    relative_head, spacy_sent_start, idx = relative_head.astype(np.int64), spacy_sent_start.astype(np.int64), idx.astype(np.int64)
+    string_store = doc.vocab.strings
     del doc
-    gc.collect()
-    torch.cuda.empty_cache()
 
-    token_id_mapping = {}
-    for i, previous_token_id in enumerate(tokens_df['token_ID_within_document'].tolist()):
-        token_id_mapping[previous_token_id] = i
-    # Replace IDs in 'token_ID_within_document' column
-    tokens_df['token_ID_within_document'] = tokens_df['token_ID_within_document'].map(token_id_mapping).fillna(
-        tokens_df['token_ID_within_document']).astype(int)
-    # Replace IDs in 'syntactic_head_ID' column
-    tokens_df['syntactic_head_ID'] = tokens_df['syntactic_head_ID'].map(token_id_mapping).fillna(
-        tokens_df['syntactic_head_ID']).astype(int)
+    word_strings, word_inverse = get_strings_from_hashes(orth, string_store)
+    words = word_strings[word_inverse]
+    word_lengths = np.array([len(word) for word in word_strings], dtype=np.int64)[word_inverse]
+    # spaCy trailing whitespace is at most a single space, so a newline can only be in the token text
+    is_newline_character = np.array(['\n' in word for word in word_strings], dtype=bool)[word_inverse]
+    is_sentence_final_punct = np.array([word in ['.', '!', '?'] for word in word_strings], dtype=bool)[word_inverse]
+
+    # Sentence starts: a token starts a sentence if it follows a newline, or if spaCy marks it as a sentence start,
+    # it is a title or a punctuation, follows a [.!?] token, and the previous token does not start a sentence.
+    token_positions = np.arange(len(orth))
+    previous_is_newline_char = np.concatenate([[True], is_newline_character[:-1]])
+    previous_is_punct = np.concatenate([[False], is_sentence_final_punct[:-1]])
+    # On "toggle" tokens, is_sent_start is the negation of the previous token's is_sent_start,
+    # elsewhere it is previous_is_newline_char. The first token is never a toggle token.
+    is_toggle = (~previous_is_newline_char
+                 & ((is_title == 1) | (is_punct == 1))
+                 & (spacy_sent_start == 1)
+                 & previous_is_punct)
+    last_known_position = np.maximum.accumulate(np.where(is_toggle, 0, token_positions))
+    toggle_parity = (token_positions - last_known_position) % 2 == 1
+    is_sent_start = np.where(is_toggle,
+                             previous_is_newline_char[last_known_position] ^ toggle_parity,
+                             previous_is_newline_char)
+
+    sentence_ID = np.cumsum(is_sent_start) - 1
+    last_sent_start_position = np.maximum.accumulate(np.where(is_sent_start, token_positions, 0))
+    token_ID_within_sentence = token_positions - last_sent_start_position
+    paragraph_ID = np.cumsum(is_newline_character) - is_newline_character
+
+    # Newline tokens are dropped: remap token IDs (and syntactic heads pointing to kept tokens) to row positions
+    is_kept = ~is_newline_character
+    new_token_IDs = np.cumsum(is_kept) - 1
+    syntactic_head_ID = token_positions + relative_head
+    syntactic_head_ID = np.where(is_kept[syntactic_head_ID], new_token_IDs[syntactic_head_ID], syntactic_head_ID)
+
+    lemma_strings, lemma_inverse = get_strings_from_hashes(lemma, string_store)
+    POS_strings, POS_inverse = get_strings_from_hashes(pos, string_store)
+    dep_strings, dep_inverse = get_strings_from_hashes(dep, string_store)
+    morph_strings, morph_inverse = get_strings_from_hashes(morph, string_store)
+    morph_strings = np.array(["" if morph_string == "_" else morph_string for morph_string in morph_strings], dtype=object)
+
+    tokens_df = pd.DataFrame({'paragraph_ID': paragraph_ID[is_kept],
+                              'sentence_ID': sentence_ID[is_kept],
+                              'token_ID_within_sentence': token_ID_within_sentence[is_kept],
+                              'token_ID_within_document': new_token_IDs[is_kept],
+                              'word': words[is_kept],
+                              'lemma': lemma_strings[lemma_inverse][is_kept],
+                              'byte_onset': idx[is_kept],
+                              'byte_offset': (idx + word_lengths)[is_kept],
+                              'POS_tag': POS_strings[POS_inverse][is_kept],
+                              'dependency_relation': dep_strings[dep_inverse][is_kept],
+                              'syntactic_head_ID': syntactic_head_ID[is_kept],
+                              'morph': morph_strings[morph_inverse][is_kept],
+                              })
 
     return tokens_df
 
-def generate_tokens_df(text_content, spacy_model, max_char_sentence_length=100000, verbose=1):
+def get_paragraph_boundaries(text_content, max_char_sentence_length=100000):
+    # Cut the text roughly every max_char_sentence_length characters, at the start of a whitespace run holding a newline,
+    # so that every sample (except the first) starts with the whitespace separating two paragraphs. spaCy parses such
+    # a run as a single newline token, whether it is cut or not, and no sample is whitespace only.
+    text_len = len(text_content)
+    content_end = len(text_content.rstrip())
+    sample_count = (text_len // max_char_sentence_length) + 1
+    sample_length = max(text_len // sample_count, 1)
+
+    boundaries = [0]
+    for target_boundary in range(sample_length, text_len, sample_length):
+        if target_boundary <= boundaries[-1]:
+            continue
+        boundary = text_content.find('\n', target_boundary)
+        if boundary == -1 or boundary >= content_end:
+            break
+        # Move back to the start of the whitespace run (trailing spaces of the paragraph included),
+        # so that it is not split between two samples
+        while boundary > boundaries[-1] and text_content[boundary - 1].isspace():
+            boundary -= 1
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+    boundaries.append(text_len)
+
+    return boundaries
+
+def shift_tokens_df(tokens_df, shift):
+    """
+    Shift the IDs and byte offsets of a tokens_df generated from a sample of a text.
+    shift holds the 'paragraph_ID', 'sentence_ID', 'token_ID_within_document' and 'byte_onset' values to add.
+    """
+    tokens_df['paragraph_ID'] += shift['paragraph_ID']
+    tokens_df['sentence_ID'] += shift['sentence_ID']
+    tokens_df['token_ID_within_document'] += shift['token_ID_within_document']
+    tokens_df['syntactic_head_ID'] += shift['token_ID_within_document']
+    tokens_df['byte_onset'] += shift['byte_onset']
+    tokens_df['byte_offset'] += shift['byte_onset']
+    return tokens_df
+
+def get_next_paragraph_shift(sample_tokens_df, shift):
+    # The next sample starts with the newline closing the last paragraph of this sample: its first token is in
+    # local paragraph 1 and sentence 1, and must follow the last row of this (not yet shifted) sample.
+    last_row = sample_tokens_df.iloc[-1]
+    return {'paragraph_ID': shift['paragraph_ID'] + int(last_row['paragraph_ID']),
+            'sentence_ID': shift['sentence_ID'] + int(last_row['sentence_ID']),
+            'token_ID_within_document': shift['token_ID_within_document'] + len(sample_tokens_df),
+            'byte_onset': None}
+
+def iterate_paragraph_windows_tokens_df(text_content, spacy_model, window_length=200000,
+                                        max_char_sentence_length=100000, verbose=1):
+    """
+    Parse the text one paragraph-aligned window of about window_length characters at a time.
+
+    Yields (window_text, window_tokens_df, shift) tuples: window_tokens_df IDs and byte offsets are relative to
+    window_text, shift_tokens_df(window_tokens_df, shift) gives the IDs and offsets within the whole text.
+    """
+    window_boundaries = get_paragraph_boundaries(text_content, max_char_sentence_length=window_length)
+    shift = {'paragraph_ID': 0, 'sentence_ID': 0, 'token_ID_within_document': 0, 'byte_onset': 0}
+    window_start = 0
+    for window_end in window_boundaries[1:]:
+        window_text = text_content[window_start:window_end]
+        window_tokens_df = generate_tokens_df(window_text, spacy_model,
+                                              max_char_sentence_length=max_char_sentence_length,
+                                              verbose=verbose)
+        if len(window_tokens_df) == 0:
+            # Whitespace only: carry it over to the start of the next window, where it is parsed as in the whole text
+            continue
+
+        shift['byte_onset'] = window_start
+        next_shift = get_next_paragraph_shift(window_tokens_df, shift)
+        yield window_text, window_tokens_df, shift
+        shift = next_shift
+        window_start = window_end
+
+def generate_tokens_df_in_parallel(text_content, spacy_model, max_char_sentence_length=100000, n_process=2, verbose=1):
+    """
+    Parse the text with spacy_model.pipe(n_process=...) over samples cut at paragraph boundaries.
+
+    Every sample starts with the newline ending the previous paragraph, so the first token of a sample always
+    starts a new sentence and paragraph: the IDs and byte offsets of a sample are shifted by the values
+    of the last row of the previous one, as in generate_tokens_df.
+    """
+    sample_boundaries = get_paragraph_boundaries(text_content, max_char_sentence_length=max_char_sentence_length)
+    sample_texts = (text_content[start_boundary:end_boundary]
+                    for start_boundary, end_boundary in zip(sample_boundaries[:-1], sample_boundaries[1:]))
+
+    samples_tokens_dfs = []
+    shift = {'paragraph_ID': 0, 'sentence_ID': 0, 'token_ID_within_document': 0, 'byte_onset': 0}
+    sample_docs = spacy_model.pipe(sample_texts, n_process=n_process, batch_size=1)
+    for sample_start, sample_doc in tqdm(zip(sample_boundaries[:-1], sample_docs), total=len(sample_boundaries) - 1,
+                                         desc='Parallel Spacy Tokenization', leave=False, disable=(verbose == 0)):
+        sample_tokens_df = generate_tokens_df_from_spacy_doc(sample_doc)
+        if len(sample_tokens_df) == 0:
+            continue
+
+        shift['byte_onset'] = sample_start
+        next_shift = get_next_paragraph_shift(sample_tokens_df, shift)
+        sample_tokens_df = shift_tokens_df(sample_tokens_df, shift)
+        shift = next_shift
+
+        samples_tokens_dfs.append(sample_tokens_df)
+
+    if len(samples_tokens_dfs) == 0:
+        return get_compact_tokens_df(pd.DataFrame(columns=TOKENS_DF_COLUMNS))
+    tokens_df = pd.concat(samples_tokens_dfs, ignore_index=True)
+    tokens_df = get_compact_tokens_df(tokens_df)
+
+    return tokens_df
+
+def generate_tokens_df(text_content, spacy_model, max_char_sentence_length=100000, n_process=1, verbose=1):
+    """
+    Parse text_content with spaCy, max_char_sentence_length characters at a time.
+
+    With n_process > 1 (CPU only), samples are cut at paragraph boundaries and parsed in parallel,
+    see generate_tokens_df_in_parallel.
+
+    The returned tokens_df uses the compact schema of get_compact_tokens_df: int32 IDs and offsets,
+    categorical word, lemma, POS_tag, dependency_relation and morph columns.
+    """
+    if n_process != 1:
+        return generate_tokens_df_in_parallel(text_content, spacy_model,
+                                              max_char_sentence_length=max_char_sentence_length,
+                                              n_process=n_process,
+                                              verbose=verbose)
+
     text_len = len(text_content)
     sample_count = (text_len // max_char_sentence_length) + 1
     sample_boundaries = [i for i in range(0, text_len, text_len // sample_count)] + [text_len]
 
-    tokens_df = pd.DataFrame()
+    # Each sample is shifted by the values of the previous sample's last sentence start row
+    shifted_columns = ['paragraph_ID', 'sentence_ID', 'token_ID_within_document', 'byte_onset', 'byte_offset', 'syntactic_head_ID']
+    shift_source_columns = ['paragraph_ID', 'sentence_ID', 'token_ID_within_document', 'byte_onset', 'byte_onset', 'token_ID_within_document']
+
+    samples_tokens_dfs = []
+    stitched_tokens_count = 0
+    shift = None
     start_boundary = 0
     for end_boundary in tqdm(sample_boundaries[1:], desc='Batch Spacy Tokenization', leave=False, disable=(verbose == 0)):
         sample_text = text_content[start_boundary:end_boundary]
         sample_doc = spacy_model(sample_text)
         sample_tokens_df = generate_tokens_df_from_spacy_doc(sample_doc)
+        del sample_doc
+        if len(sample_tokens_df) == 0:
+            # Whitespace only: it is parsed again at the start of the next sample
+            continue
 
-        if len(tokens_df) == 0:
-            max_sentence_id = sample_tokens_df['sentence_ID'].max()
-            last_sentence_start_row = sample_tokens_df[sample_tokens_df['sentence_ID'] == max_sentence_id].iloc[0]
-            if end_boundary != sample_boundaries[-1]:
-                sample_tokens_df = sample_tokens_df.iloc[:last_sentence_start_row.name]
-            tokens_df = sample_tokens_df
-
-        else:
-            sample_tokens_df['paragraph_ID'] = sample_tokens_df['paragraph_ID'] + previous_last_sentence_start_row[
-                'paragraph_ID']
-            sample_tokens_df['sentence_ID'] = sample_tokens_df['sentence_ID'] + previous_last_sentence_start_row[
-                'sentence_ID']
-            sample_tokens_df['token_ID_within_document'] = sample_tokens_df['token_ID_within_document'] + \
-                                                           previous_last_sentence_start_row['token_ID_within_document']
-            sample_tokens_df['byte_onset'] = sample_tokens_df['byte_onset'] + previous_last_sentence_start_row[
-                'byte_onset']
-            sample_tokens_df['byte_offset'] = sample_tokens_df['byte_offset'] + previous_last_sentence_start_row[
-                'byte_onset']
-            sample_tokens_df['syntactic_head_ID'] = sample_tokens_df['syntactic_head_ID'] + \
-                                                    previous_last_sentence_start_row['token_ID_within_document']
-
-            max_sentence_id = sample_tokens_df['sentence_ID'].max()
-            last_sentence_start_row = sample_tokens_df[sample_tokens_df['sentence_ID'] == max_sentence_id].iloc[0]
-            if end_boundary != sample_boundaries[-1]:
-                sample_tokens_df = sample_tokens_df.iloc[:last_sentence_start_row.name]
-
-            tokens_df = pd.concat([tokens_df, sample_tokens_df], ignore_index=True)
-
-        previous_last_sentence_start_row = last_sentence_start_row
-        start_boundary = previous_last_sentence_start_row['byte_onset']
+        if stitched_tokens_count > 0:
+            sample_tokens_df[shifted_columns] += shift
 
-        del sample_doc
-        gc.collect()
-        torch.cuda.empty_cache()
+        # The last sentence of the sample may be cut: it is parsed again at the start of the next sample
+        sentence_IDs = sample_tokens_df['sentence_ID'].to_numpy()
+        last_sentence_start_position = int(np.argmax(sentence_IDs == sentence_IDs.max()))
+        shift = sample_tokens_df[shift_source_columns].to_numpy()[last_sentence_start_position]
+        if end_boundary != sample_boundaries[-1]:
+            sample_tokens_df = sample_tokens_df.iloc[:last_sentence_start_position]
+
+        samples_tokens_dfs.append(sample_tokens_df)
+        stitched_tokens_count += len(sample_tokens_df)
+        start_boundary = int(shift[3])
+
+    if len(samples_tokens_dfs) == 0:
+        return get_compact_tokens_df(pd.DataFrame(columns=TOKENS_DF_COLUMNS))
+    tokens_df = pd.concat(samples_tokens_dfs, ignore_index=True)
+    del samples_tokens_dfs
+    tokens_df = get_compact_tokens_df(tokens_df)
+    gc.collect()
+    torch.cuda.empty_cache()
 
     return tokens_df
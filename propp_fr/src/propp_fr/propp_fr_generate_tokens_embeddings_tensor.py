@@ -1,9 +1,13 @@
 from transformers import AutoTokenizer, AutoModel, MT5EncoderModel, AutoTokenizer, T5EncoderModel
+from transformers.modeling_outputs import BaseModelOutput
 import torch
 import numpy as np
 from tqdm.auto import tqdm
 import pandas as pd
 import gc
+import os
+import json
+import time
 
 #def load_tokenizer_and_embedding_model(model_name="almanach/camembert-large"):
 #
@@ -16,13 +20,211 @@ import gc
 #
 #    return tokenizer, model
     
-def load_tokenizer_and_embedding_model(model_name):
+EMBEDDING_INFERENCE_MODES = ["float32", "bfloat16", "int8"]
+EMBEDDING_BACKENDS = ["torch", "onnx"]
+
+def get_encoder_layers(model):
+    # The transformer blocks of BERT-like encoders (CamemBERT, RoBERTa...) and of T5 encoders
+    encoder = getattr(model, "encoder", None)
+    for layers_attribute in ["layer", "block"]:
+        if isinstance(getattr(encoder, layers_attribute, None), torch.nn.ModuleList):
+            return encoder, layers_attribute
+    raise ValueError(f"Cannot find the transformer layers of {type(model).__name__}, only hidden_layers='last' is supported.")
+
+def get_hidden_layers_weights(hidden_layers, num_hidden_layers):
     """
-    Loads tokenizer and embedding model with hidden states enabled.
-    Supports encoder-only transformers and T5 (encoder).
+    Returns the {layer: weight} selection of hidden layers, layers numbered from 1 (first transformer layer)
+    to num_hidden_layers (last layer, the default). hidden_layers can be:
+    - "last": the last hidden state.
+    - an int: a single layer, negative values counting from the end (-1 is the last layer).
+    - a {layer: weight} dict: a weighted sum of a few layers, e.g. {-1: 0.5, -2: 0.25, -3: 0.25}.
+    """
+    if hidden_layers == "last":
+        hidden_layers = {num_hidden_layers: 1.0}
+    elif isinstance(hidden_layers, int):
+        hidden_layers = {hidden_layers: 1.0}
+    elif not isinstance(hidden_layers, dict):
+        raise ValueError(f"hidden_layers must be 'last', a layer number or a {{layer: weight}} dict, not {hidden_layers!r}.")
+
+    hidden_layers_weights = {}
+    for selected_layer, weight in hidden_layers.items():
+        layer = selected_layer + num_hidden_layers + 1 if selected_layer < 0 else selected_layer
+        if not 1 <= layer <= num_hidden_layers:
+            raise ValueError(f"Hidden layer {selected_layer} out of range, the encoder has layers 1 to {num_hidden_layers}.")
+        hidden_layers_weights[layer] = hidden_layers_weights.get(layer, 0.0) + float(weight)
+    return hidden_layers_weights
+
+def select_hidden_layers(model, hidden_layers="last"):
     """
+    Makes model(...).last_hidden_state return the selected hidden layers (see get_hidden_layers_weights).
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    The layers above the highest selected one are dropped, and forward hooks keep only the outputs of the
+    selected layers alive during a forward pass (instead of all of them with output_hidden_states=True).
+    """
+    encoder, layers_attribute = get_encoder_layers(model)
+    layers = getattr(encoder, layers_attribute)
+    num_hidden_layers = len(layers)
+    hidden_layers_weights = get_hidden_layers_weights(hidden_layers, num_hidden_layers)
+    model.embedding_hidden_layers = hidden_layers
+    model.embedding_hidden_layers_weights = hidden_layers_weights
+    if hidden_layers_weights == {num_hidden_layers: 1.0}:
+        return model
+
+    # The outputs of the upper layers are never read
+    setattr(encoder, layers_attribute, layers[:max(hidden_layers_weights)])
+
+    selected_hidden_states = {}
+
+    def get_layer_hook(layer):
+        def store_hidden_states(module, inputs, outputs):
+            selected_hidden_states[layer] = outputs[0] if isinstance(outputs, tuple) else outputs
+        return store_hidden_states
+
+    for layer in hidden_layers_weights:
+        # The last layer is read from the model output, which some encoders (T5) normalize
+        if layer != num_hidden_layers:
+            layers[layer - 1].register_forward_hook(get_layer_hook(layer))
+
+    def replace_last_hidden_state(module, inputs, outputs):
+        selected_hidden_states[num_hidden_layers] = outputs.last_hidden_state
+        # Weighted sum of the selected layers, computed in their order so that the result is deterministic
+        outputs.last_hidden_state = sum(weight * selected_hidden_states.pop(layer)
+                                        for layer, weight in sorted(hidden_layers_weights.items()))
+        selected_hidden_states.clear()
+        return outputs
+
+    model.register_forward_hook(replace_last_hidden_state)
+    return model
+
+class LastHiddenStateEncoder(torch.nn.Module):
+    # Traceable wrapper returning only the last hidden states (or the selected hidden layers), the output used by compute_sub_word_embeddings
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids, attention_mask=attention_mask).last_hidden_state
+
+def export_embedding_model_to_onnx(model, onnx_path, opset_version=17):
+    """Exports the encoder to ONNX, with dynamic batch and sequence axes."""
+    os.makedirs(os.path.dirname(onnx_path) or ".", exist_ok=True)
+    dummy_input_ids = torch.ones((2, 8), dtype=torch.long)
+    dummy_attention_mask = torch.ones((2, 8), dtype=torch.long)
+    # Write to a temporary file first, so that an interrupted export is never loaded
+    temporary_onnx_path = f"{onnx_path}.{os.getpid()}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(LastHiddenStateEncoder(model).eval(),
+                          (dummy_input_ids, dummy_attention_mask),
+                          temporary_onnx_path,
+                          input_names=["input_ids", "attention_mask"],
+                          output_names=["last_hidden_state"],
+                          dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                                        "attention_mask": {0: "batch", 1: "sequence"},
+                                        "last_hidden_state": {0: "batch", 1: "sequence"}},
+                          opset_version=opset_version,
+                          dynamo=False)
+    os.replace(temporary_onnx_path, onnx_path)
+
+class ONNXEmbeddingModel:
+    """
+    Encoder run with ONNX Runtime on CPU, called like the PyTorch encoder by compute_sub_word_embeddings:
+    model(input_ids, attention_mask=attention_mask).last_hidden_state
+
+    intra_op_num_threads sets the threads used inside each operator (matrix multiplications), and
+    inter_op_num_threads the threads running independent operators; None lets ONNX Runtime use all cores.
+    """
+
+    def __init__(self, onnx_path, config, intra_op_num_threads=None, inter_op_num_threads=None):
+        import onnxruntime  # Optional dependency, only needed by the onnx backend
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_num_threads is not None:
+            session_options.intra_op_num_threads = intra_op_num_threads
+        if inter_op_num_threads is not None:
+            session_options.inter_op_num_threads = inter_op_num_threads
+            session_options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+
+        self.onnx_path = onnx_path
+        self.config = config
+        self.session = onnxruntime.InferenceSession(onnx_path, sess_options=session_options, providers=["CPUExecutionProvider"])
+        self.embedding_inference_mode = "float32"
+        self.embedding_backend = "onnx"
+
+    def __call__(self, input_ids, attention_mask=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        last_hidden_state, = self.session.run(["last_hidden_state"],
+                                              {"input_ids": input_ids.cpu().numpy(),
+                                               "attention_mask": attention_mask.cpu().numpy()})
+        return BaseModelOutput(last_hidden_state=torch.from_numpy(last_hidden_state))
+
+    def eval(self):
+        return self
+
+def compile_embedding_model(model, batch_size, window_length, padding_token_id=0):
+    """
+    Compiles the encoder with torch.compile for a single static (batch_size, window_length) input shape,
+    and runs a warm-up batch so that the compilation cost is paid at load time.
+    compute_sub_word_embeddings then pads every batch to this shape (see embedding_static_shape).
+    """
+    model.compile(dynamic=False)
+    model.embedding_static_shape = (batch_size, window_length)
+
+    device = next(model.parameters()).device
+    warmup_input_ids = torch.full((batch_size, window_length), padding_token_id, dtype=torch.long, device=device)
+    warmup_attention_mask = torch.ones((batch_size, window_length), dtype=torch.long, device=device)
+    use_bfloat16_autocast = getattr(model, "embedding_inference_mode", "float32") == "bfloat16"
+    start_time = time.perf_counter()
+    with torch.no_grad(), torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bfloat16_autocast):
+        model(warmup_input_ids, attention_mask=warmup_attention_mask)
+    print(f"Encoder compiled for ({batch_size}, {window_length}) inputs in {time.perf_counter() - start_time:.1f}s")
+    return model
+
+def load_tokenizer_and_embedding_model(model_name, inference_mode="float32",
+                                       hidden_layers="last",
+                                       backend="torch",
+                                       onnx_directory=None,
+                                       intra_op_num_threads=None,
+                                       inter_op_num_threads=None,
+                                       compile_encoder=False,
+                                       compiled_batch_size=12,
+                                       compiled_window_length='max'):
+    """
+    Loads tokenizer and embedding model.
+    Supports encoder-only transformers and T5 (encoder).
+
+    hidden_layers selects the encoder output used as subword embeddings: "last" (default), a single layer,
+    or a weighted sum of a few layers (see get_hidden_layers_weights). Only the selected layers are kept
+    in memory during a forward pass, and the layers above them are not computed.
+
+    inference_mode trades some accuracy for encoder speed:
+    - "float32": default, full precision.
+    - "bfloat16": the encoder runs under bf16 autocast (see compute_sub_word_embeddings).
+    - "int8": dynamic int8 quantization of the encoder linear layers (CPU only).
+
+    backend="onnx" runs the (float32) encoder with ONNX Runtime on CPU instead of PyTorch (the export needs onnx,
+    inference onnxruntime). The encoder is exported once to onnx_directory (default: ~/.cache/propp_fr/onnx) and the export is reused
+    by the next loads. intra_op_num_threads / inter_op_num_threads set the ONNX Runtime thread counts.
+
+    compile_encoder=True compiles the PyTorch encoder (float32 or bfloat16) for static (compiled_batch_size,
+    compiled_window_length) inputs, the sliding window size by default, and warms it up at load time (see
+    compile_embedding_model). On CPU, torch then uses intra_op_num_threads threads, by default all the cores
+    available to the process (torch defaults to all the machine cores, even when the process is restricted
+    to a few of them).
+    """
+    if inference_mode not in EMBEDDING_INFERENCE_MODES:
+        raise ValueError(f"Unknown inference_mode '{inference_mode}', expected one of {EMBEDDING_INFERENCE_MODES}.")
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {EMBEDDING_BACKENDS}.")
+    if backend == "onnx" and inference_mode != "float32":
+        raise ValueError("The onnx backend only supports the float32 inference_mode.")
+    if compile_encoder and (backend != "torch" or inference_mode == "int8"):
+        raise ValueError("compile_encoder is only supported by the torch backend, with the float32 or bfloat16 inference_mode.")
+
+    device = torch.device("cuda" if torch.cuda.is_available() and backend == "torch" else "cpu")
+    if inference_mode == "int8" and device.type != "cpu":
+        raise ValueError("The int8 inference_mode uses dynamic quantization, which only runs on CPU.")
 
     tokenizer = AutoTokenizer.from_pretrained(model_name)
 
@@ -30,83 +232,155 @@ def load_tokenizer_and_embedding_model(model_name):
         # T5 is encoder-decoder → we ONLY want the encoder
         model = MT5EncoderModel.from_pretrained(
             model_name,
-            output_hidden_states=True
+            output_hidden_states=False
         )
         print(f"Loaded MT5 encoder: {model_name}")
     elif "t5" in model_name.lower():
         # T5 is encoder-decoder → we ONLY want the encoder
         model = T5EncoderModel.from_pretrained(
             model_name,
-            output_hidden_states=True
+            output_hidden_states=False
         )
         print(f"Loaded T5 encoder: {model_name}")
     elif "ul2" in model_name.lower():
         model = T5EncoderModel.from_pretrained(
             model_name,
-            output_hidden_states=True,
+            output_hidden_states=False,
             torch_dtype=torch.float16,
         )
         print(f"Loaded ul2 encoder: {model_name}")
     else:
         model = AutoModel.from_pretrained(
             model_name,
-            output_hidden_states=True
+            output_hidden_states=False
         )
         print(f"Loaded encoder model: {model_name}")
 
     model.to(device)
     model.eval()  # IMPORTANT for embedding extraction
+    if hidden_layers != "last":
+        model = select_hidden_layers(model, hidden_layers)
+        print(f"Encoder hidden layers: {hidden_layers}")
+
+    if inference_mode == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.embedding_inference_mode = inference_mode
+    model.embedding_backend = "torch"
+    model.embedding_hidden_layers = hidden_layers
+    if inference_mode != "float32":
+        print(f"Encoder inference mode: {inference_mode}")
+
+    if backend == "torch" and device.type == "cpu":
+        if compile_encoder and intra_op_num_threads is None:
+            intra_op_num_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        if intra_op_num_threads is not None:
+            torch.set_num_threads(intra_op_num_threads)
+    if compile_encoder:
+        model = compile_embedding_model(model,
+                                        batch_size=compiled_batch_size,
+                                        window_length=get_sliding_window_size(tokenizer, compiled_window_length),
+                                        padding_token_id=int(tokenizer.pad_token_id))
+
+    if backend == "onnx":
+        if onnx_directory is None:
+            onnx_directory = os.path.join(os.path.expanduser("~"), ".cache", "propp_fr", "onnx")
+        onnx_file_name = model_name.replace('/', '__')
+        if hidden_layers != "last":
+            onnx_file_name += "_layers_" + "_".join(f"{layer}x{weight:g}" for layer, weight in sorted(model.embedding_hidden_layers_weights.items()))
+        onnx_path = os.path.join(onnx_directory, f"{onnx_file_name}.onnx")
+        if not os.path.exists(onnx_path):
+            print(f"Exporting encoder to ONNX: {onnx_path}")
+            export_embedding_model_to_onnx(model, onnx_path)
+        model = ONNXEmbeddingModel(onnx_path, model.config,
+                                   intra_op_num_threads=intra_op_num_threads,
+                                   inter_op_num_threads=inter_op_num_threads)
+        model.embedding_hidden_layers = hidden_layers
+        print(f"Encoder backend: ONNX Runtime ({onnx_path})")
 
     return tokenizer, model
     
 
-def tokenize_text(text, tokenizer):
-    """Tokenizes text and retrieves token IDs with byte offsets"""
-    encoding = tokenizer(text,
-                         return_offsets_mapping=True,
-                         return_tensors="pt",
-                         return_attention_mask=False,
-                         add_special_tokens=False)
+def get_paragraph_chunks_boundaries(text, chunk_length=100000):
+    # Cut the text every ~chunk_length characters, at the start of a paragraph (a non-whitespace character
+    # following a newline). Chunks are returned as (start, end) spans, end excluding the whitespace before the
+    # next chunk, so that no subword is split. Texts shorter than chunk_length are a single, unchanged chunk.
+    chunks_boundaries = []
+    chunk_start = 0
+    while chunk_start < len(text):
+        chunk_end = len(text)
+        if chunk_start + chunk_length < len(text):
+            newline_position = text.find("\n", chunk_start + chunk_length)
+            if newline_position != -1:
+                next_chunk_start = newline_position + 1
+                while next_chunk_start < len(text) and text[next_chunk_start].isspace():
+                    next_chunk_start += 1
+                chunk_end = next_chunk_start
+        content_end = chunk_end
+        while chunk_end < len(text) and content_end > chunk_start and text[content_end - 1].isspace():
+            content_end -= 1
+        if content_end > chunk_start:
+            chunks_boundaries.append((chunk_start, content_end))
+        chunk_start = chunk_end
+    return chunks_boundaries
+
+def tokenize_text(text, tokenizer, chunk_length=100000):
+    """
+    Tokenizes text and retrieves subword IDs with their (start, end) character offsets in the text.
 
-    subword_ids = encoding["input_ids"].squeeze().tolist()  # Token IDs
-    subword_offsets = encoding["offset_mapping"].squeeze().tolist()  # (Start, End) byte positions
-    subwords = tokenizer.convert_ids_to_tokens(subword_ids)  # Convert IDs to readable tokens
+    Long texts are cut into ~chunk_length characters chunks on paragraph boundaries, tokenized in one batch call
+    (run in parallel by fast tokenizers), and the chunk offsets are shifted back to text positions.
+    """
+    chunks_boundaries = get_paragraph_chunks_boundaries(text, chunk_length=chunk_length)
+    if len(chunks_boundaries) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 2), dtype=np.int64)
+    encodings = tokenizer([text[chunk_start:chunk_end] for chunk_start, chunk_end in chunks_boundaries],
+                          return_offsets_mapping=True,
+                          return_attention_mask=False,
+                          add_special_tokens=False)
 
-    return subwords, subword_ids, subword_offsets
+    subword_ids = np.fromiter((subword_id for chunk_subword_ids in encodings["input_ids"] for subword_id in chunk_subword_ids), dtype=np.int64)
+    subword_offsets = [np.asarray(chunk_offsets, dtype=np.int64).reshape(-1, 2) + chunk_start
+                       for chunk_offsets, (chunk_start, _) in zip(encodings["offset_mapping"], chunks_boundaries)]
+    subword_offsets = np.concatenate(subword_offsets)
 
-def find_subwords_for_tokens(tokens_df, subword_offsets):
-    subword_onsets = np.array([offset[0] for offset in subword_offsets])
-    subword_offsets = np.array([offset[1] for offset in subword_offsets])
+    return subword_ids, subword_offsets
 
-    tokens_subword_ids = []
+def find_subwords_for_tokens(tokens_df, subword_offsets):
+    """
+    Align each token with the subwords overlapping its byte span.
 
-    for token_byte_onset, token_byte_offset in tokens_df[["byte_onset", "byte_offset"]].values:
-        # Find the first subword that starts at or before the token onset
-        start_idx = np.searchsorted(subword_onsets, token_byte_onset, side="right") - 1
-        start_idx = max(start_idx, 0)  # Ensure we don't go below index 0
+    The subwords of a token are contiguous, so the alignment is returned in CSR form: the subwords of token i
+    are tokens_subword_ids[tokens_subword_ids_offsets[i]:tokens_subword_ids_offsets[i + 1]].
+    """
+    subword_offsets = np.asarray(subword_offsets, dtype=np.int64).reshape(-1, 2)
+    subword_onsets, subword_offsets = subword_offsets[:, 0], subword_offsets[:, 1]
+    token_onsets = tokens_df["byte_onset"].to_numpy(dtype=np.int64)
+    token_offsets = tokens_df["byte_offset"].to_numpy(dtype=np.int64)
 
-        # Expand right while ensuring subwords still overlap with the token
-        end_idx = start_idx
-        while end_idx < len(subword_offsets) and subword_onsets[end_idx] < token_byte_offset:
-            end_idx += 1
+    if len(subword_onsets) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(len(token_onsets) + 1, dtype=np.int64)
 
-        # Allow subwords that start before the token but overlap significantly
-        contained_subwords_ids = [
-            i for i in range(start_idx, end_idx)
-            if not (subword_offsets[i] <= token_byte_onset or subword_onsets[i] >= token_byte_offset)
-        ]
+    # First candidate: the last subword starting at or before the token onset
+    start_ids = np.maximum(np.searchsorted(subword_onsets, token_onsets, side="right") - 1, 0)
+    # Candidates end at the first subword starting at or after the token offset
+    end_ids = np.maximum(np.searchsorted(subword_onsets, token_offsets, side="left"), start_ids)
+    # Only the first candidate can end before the token onset, every following one starts after it
+    start_ids += (start_ids < end_ids) & (subword_offsets[start_ids] <= token_onsets)
 
-        tokens_subword_ids.append(contained_subwords_ids)
+    subword_counts = end_ids - start_ids
+    tokens_subword_ids_offsets = np.concatenate([[0], np.cumsum(subword_counts)])
+    tokens_subword_ids = (np.arange(tokens_subword_ids_offsets[-1])
+                          - np.repeat(tokens_subword_ids_offsets[:-1] - start_ids, subword_counts))
 
-    return tokens_subword_ids
+    return tokens_subword_ids, tokens_subword_ids_offsets
 
 def get_boudaries_list(tokens_df, sub_word_offsets, sliding_window_size=0, sliding_window_overlap=0.5):
     import numpy as np
 
-    token_offsets = np.array(tokens_df["byte_offset"].tolist())
-    token_offset_set = set(token_offsets)
+    sub_word_offsets = np.asarray(sub_word_offsets, dtype=np.int64).reshape(-1, 2)
+    token_offsets = tokens_df["byte_offset"].to_numpy(dtype=np.int64)
 
-    possible_end_tokens = np.array([i for i, (_, end) in enumerate(sub_word_offsets) if end in token_offset_set])
+    possible_end_tokens = np.flatnonzero(np.isin(sub_word_offsets[:, 1], token_offsets))
     possible_start_tokens = np.array([0] + (possible_end_tokens + 1).tolist())
 
     overlapping_window_boundaries = []
@@ -143,86 +417,99 @@ def get_boudaries_list(tokens_df, sub_word_offsets, sliding_window_size=0, slidi
 
     return overlapping_window_boundaries
 
-def compute_sub_word_embeddings(boundaries_list, token_ids, model, mini_batch_size=10, padding_token_id=0, sliding_window_size=0, device='cpu', verbose=1):
+def get_length_aware_batches(window_lengths, max_tokens_per_batch):
+    # Sort windows by length (longest first) and group them so that a batch padded to its longest
+    # window holds at most max_tokens_per_batch subwords (and at least one window)
+    sorted_window_ids = np.argsort(-np.asarray(window_lengths), kind="stable")
+    batches = []
+    batch = []
+    for window_id in sorted_window_ids:
+        if window_lengths[window_id] == 0:
+            continue
+        if batch and (len(batch) + 1) * window_lengths[batch[0]] > max_tokens_per_batch:
+            batches.append(batch)
+            batch = []
+        batch.append(int(window_id))
+    if batch:
+        batches.append(batch)
+    return batches
+
+def compute_sub_word_embeddings(boundaries_list, token_ids, model, mini_batch_size=10, padding_token_id=0, sliding_window_size=0, device='cpu', verbose=1, max_tokens_per_batch=None):
+    """
+    Embed the subwords of every sliding window. The outputs of overlapping windows are summed in place,
+    returning the (num_subwords, embedding_dim) sum and the number of windows covering each subword.
+
+    Windows are batched by length under a budget of max_tokens_per_batch subwords (mini_batch_size full
+    windows by default), and each batch is only padded to its longest window. Encoders compiled for a static
+    input shape get batches of exactly that shape instead.
+    """
+    if max_tokens_per_batch is None:
+        max_tokens_per_batch = mini_batch_size * sliding_window_size
 
     # Convert token_ids to a single tensor before the loop
     token_ids = torch.tensor(token_ids, dtype=torch.long, device=device)
-    max_token_id = token_ids.size(0)
 
-    # Precompute the padding tensor once
-    padding_tensor = torch.tensor([padding_token_id] * sliding_window_size, dtype=torch.long).unsqueeze(0).to(device)
+    window_starts = np.array([start_boundary for start_boundary, _ in boundaries_list], dtype=np.int64)
+    window_lengths = np.array([end_boundary - start_boundary for start_boundary, end_boundary in boundaries_list], dtype=np.int64)
 
-    batch_input_ids = []
-    all_embeddings_batches = []
+    # Number of windows covering each subword, from a difference array over the window boundaries
+    coverage_changes = np.zeros(len(token_ids) + 1, dtype=np.int64)
+    np.add.at(coverage_changes, window_starts, 1)
+    np.add.at(coverage_changes, window_starts + window_lengths, -1)
+    subword_counts = torch.from_numpy(np.cumsum(coverage_changes[:-1]))
 
-    with torch.no_grad():
-        for start_boundary, end_boundary in tqdm(boundaries_list, desc='Embedding Tokens', leave=False, disable=(verbose == 0)):
-            input_ids = token_ids[start_boundary:end_boundary]
-            real_tokens_length = input_ids.size(0)
+    # Models loaded with inference_mode="bfloat16" run under bf16 autocast
+    use_bfloat16_autocast = getattr(model, "embedding_inference_mode", "float32") == "bfloat16"
 
-            # Pad only if needed
-            if real_tokens_length < sliding_window_size:
-                padded_input = torch.cat([input_ids.unsqueeze(0), padding_tensor[:, real_tokens_length:]], dim=1)
+    # Compiled models (see compile_embedding_model) get every batch padded to their static input shape
+    static_shape = getattr(model, "embedding_static_shape", None)
+    if static_shape is not None and window_lengths.max(initial=0) <= static_shape[1]:
+        static_batch_size, static_length = static_shape
+        batches = get_length_aware_batches(np.where(window_lengths > 0, static_length, 0), static_batch_size * static_length)
+    else:
+        static_shape = None
+        batches = get_length_aware_batches(window_lengths, max_tokens_per_batch)
+
+    subword_embeddings_sum = None
+    with torch.no_grad(), torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=use_bfloat16_autocast):
+        for batch in tqdm(batches, desc='Embedding Tokens', leave=False, disable=(verbose == 0)):
+            # Pre-allocated inputs, padded to the longest window of the batch (or to the static shape)
+            if static_shape is None:
+                batch_rows, batch_length = len(batch), int(window_lengths[batch[0]])
             else:
-                padded_input = input_ids.unsqueeze(0)
-
-
-            batch_input_ids.append(padded_input)
-
-            # Process the batch based on the specified conditions
-            if (len(batch_input_ids) == mini_batch_size) or (
-                    end_boundary >= max_token_id):  # Ensure end_boundary is a single value
-                # Process the batch
-                batch_input_ids_tensor = torch.cat(batch_input_ids,
-                                                   dim=0)  # Concatenate all input tensors along the batch dimension
-                attention_mask = (batch_input_ids_tensor != padding_token_id).long()  # Create attention mask
-
-                # Move to device if not already
-                batch_input_ids_tensor = batch_input_ids_tensor.to(device)
-                attention_mask = attention_mask.to(device)
-
-                # Get model outputs
-                outputs = model(batch_input_ids_tensor, attention_mask=attention_mask)
-                last_hidden_states = outputs.last_hidden_state  # Get last hidden states
-
-                # Reshape last hidden states
-                last_hidden_states = last_hidden_states.view(-1, last_hidden_states.shape[2])
-
-                # Flatten hidden states and filter out padding
-                token_embeddings = last_hidden_states[attention_mask.view(-1) == 1]
-
-                all_embeddings_batches.append(token_embeddings.cpu())
-
-                # Reset the batch
-                batch_input_ids = []
-
-    # Concatenate all embeddings
-    all_embeddings = torch.cat(all_embeddings_batches)
-
-    subword_indices = []
-    for start_boundary, end_boundary in boundaries_list:
-        subword_indices += list(range(start_boundary, end_boundary))
-
-    return subword_indices, all_embeddings
-
-def average_embeddings_from_overlapping_sliding_windows(subword_indices, all_embeddings):
-    subword_indices = torch.tensor(subword_indices, device=all_embeddings.device)  # Convert to tensor
-    unique_indices, inverse_indices = torch.unique(subword_indices, return_inverse=True)  # Get unique indices
-
-    # Get counts for each unique subword index
-    counts = torch.bincount(inverse_indices, minlength=len(unique_indices)).float().unsqueeze(1)
-
-    # Use bincount to sum embeddings efficiently
-    summed_embeddings = torch.zeros((len(unique_indices), all_embeddings.shape[1]), device=all_embeddings.device)
-    summed_embeddings.index_add_(0, inverse_indices, all_embeddings)
+                batch_rows, batch_length = static_shape
+            batch_input_ids_tensor = torch.full((batch_rows, batch_length), padding_token_id, dtype=torch.long, device=device)
+            attention_mask = torch.zeros((batch_rows, batch_length), dtype=torch.long, device=device)
+            for row, window_id in enumerate(batch):
+                window_start, window_length = window_starts[window_id], window_lengths[window_id]
+                batch_input_ids_tensor[row, :window_length] = token_ids[window_start:window_start + window_length]
+                attention_mask[row, :window_length] = 1
+
+            # Get model outputs
+            outputs = model(batch_input_ids_tensor, attention_mask=attention_mask)
+            last_hidden_states = outputs.last_hidden_state.float().cpu()  # Get last hidden states, summed in float32
+
+            if subword_embeddings_sum is None:
+                subword_embeddings_sum = torch.zeros((len(token_ids), last_hidden_states.shape[2]), dtype=last_hidden_states.dtype)
+            # Add the embeddings of each window at its subword positions, dropping padding
+            for row, window_id in enumerate(batch):
+                window_start, window_length = window_starts[window_id], window_lengths[window_id]
+                subword_embeddings_sum[window_start:window_start + window_length] += last_hidden_states[row, :window_length]
+
+    return subword_embeddings_sum, subword_counts
+
+def average_embeddings_from_overlapping_sliding_windows(subword_embeddings_sum, subword_counts):
+    # Subwords covered by no window (if any) keep a zero embedding
+    counts = subword_counts.clamp(min=1).to(subword_embeddings_sum.dtype).unsqueeze(1)
 
     # Compute mean embeddings
-    mean_embeddings = summed_embeddings / counts
+    mean_embeddings = subword_embeddings_sum.div_(counts)
 
     return mean_embeddings
 
 def get_token_embeddings(mean_subword_embeddings,
                          tokens_subword_ids,
+                         tokens_subword_ids_offsets,
                          subword_pooling_strategy="average" # ["average", "first", "last", "first_last"]
                          ):
 
@@ -231,48 +518,95 @@ def get_token_embeddings(mean_subword_embeddings,
 
     Args:
         mean_subword_embeddings (torch.Tensor): Tensor containing subword embeddings (num_subwords, embedding_dim).
-        tokens_subword_ids (list of lists): List of lists where each list contains the indices of the subwords
-                                            corresponding to a token.
+        tokens_subword_ids (np.ndarray): Flat array of the subword indices of all tokens (CSR indices).
+        tokens_subword_ids_offsets (np.ndarray): The subwords of token i are
+                                                 tokens_subword_ids[tokens_subword_ids_offsets[i]:tokens_subword_ids_offsets[i + 1]].
         subword_pooling_strategy (str): The pooling strategy to use for merging subword embeddings. Options are:
                                        "average", "first", "last", "first_last".
 
     Returns:
-        torch.Tensor: Token-level embeddings with shape (len(tokens_subword_ids), embedding_dim)
+        torch.Tensor: Token-level embeddings with shape (len(tokens_subword_ids_offsets) - 1, embedding_dim)
     """
 
-    # Pre-allocate zero tensor using the shape of the first subword embedding
-    zero_tensor = torch.zeros(mean_subword_embeddings.shape[1])
+    if subword_pooling_strategy not in ["average", "first", "last", "first_last", "max"]:
+        raise ValueError(f"Unknown pooling strategy: {subword_pooling_strategy}")
+
+    device = mean_subword_embeddings.device
+    tokens_subword_ids = torch.as_tensor(tokens_subword_ids, dtype=torch.long, device=device)
+    tokens_subword_ids_offsets = torch.as_tensor(tokens_subword_ids_offsets, dtype=torch.long, device=device)
+    subword_counts = tokens_subword_ids_offsets[1:] - tokens_subword_ids_offsets[:-1]
+
+    # Tokens without subwords keep a zero row
+    token_embeddings = torch.zeros(len(subword_counts), mean_subword_embeddings.shape[1],
+                                   dtype=mean_subword_embeddings.dtype, device=device)
+    non_empty_tokens = torch.nonzero(subword_counts > 0).squeeze(1)
+    if len(non_empty_tokens) == 0:
+        return token_embeddings
+
+    # Apply pooling strategy over all tokens at once
+    if subword_pooling_strategy in ["average", "max"]:
+        # Segment reduction: each subword row is reduced into the row of its token
+        subword_token_ids = torch.repeat_interleave(torch.arange(len(subword_counts), device=device), subword_counts)
+        token_subword_embeddings = mean_subword_embeddings[tokens_subword_ids]
+        if subword_pooling_strategy == "average":
+            # Average the embeddings of all subwords
+            token_embeddings.index_add_(0, subword_token_ids, token_subword_embeddings)
+            token_embeddings[non_empty_tokens] /= subword_counts[non_empty_tokens].unsqueeze(1).to(token_embeddings.dtype)
+        else:
+            # Take the maximum value across subwords
+            token_embeddings.scatter_reduce_(0, subword_token_ids.unsqueeze(1).expand_as(token_subword_embeddings),
+                                             token_subword_embeddings, reduce="amax", include_self=False)
+    else:
+        first_subword_ids = tokens_subword_ids[tokens_subword_ids_offsets[:-1][non_empty_tokens]]
+        last_subword_ids = tokens_subword_ids[tokens_subword_ids_offsets[1:][non_empty_tokens] - 1]
+        if subword_pooling_strategy == "first":
+            # Take the first subword embedding
+            token_embeddings[non_empty_tokens] = mean_subword_embeddings[first_subword_ids]
+        elif subword_pooling_strategy == "last":
+            # Take the last subword embedding
+            token_embeddings[non_empty_tokens] = mean_subword_embeddings[last_subword_ids]
+        else:
+            # Average the first and last subword embeddings
+            token_embeddings[non_empty_tokens] = (mean_subword_embeddings[first_subword_ids]
+                                                  + mean_subword_embeddings[last_subword_ids]) / 2
 
-    # Initialize an empty tensor for token embeddings (same length as number of tokens)
-    token_embeddings = torch.zeros(len(tokens_subword_ids), mean_subword_embeddings.shape[1])
+    return token_embeddings
 
-    for idx, token_subword_ids in enumerate(tokens_subword_ids):
-        if len(token_subword_ids) == 0:
-            token_embeddings[idx] = zero_tensor
+def get_sliding_window_size(tokenizer, sliding_window_size='max'):
+    if sliding_window_size=='max':
+        if tokenizer.model_max_length > 100000:
+            sliding_window_size = 512
         else:
-            # Extract the subword embeddings corresponding to the current token
-            token_subword_embeddings = mean_subword_embeddings[token_subword_ids]
-
-            # Apply pooling strategy
-            if subword_pooling_strategy == "average":
-                # Average the embeddings of all subwords
-                token_embeddings[idx] = token_subword_embeddings.mean(dim=0)
-            elif subword_pooling_strategy == "first":
-                # Take the first subword embedding
-                token_embeddings[idx] = token_subword_embeddings[0]
-            elif subword_pooling_strategy == "last":
-                # Take the last subword embedding
-                token_embeddings[idx] = token_subword_embeddings[-1]
-            elif subword_pooling_strategy == "first_last":
-                # Average the first and last subword embeddings
-                token_embeddings[idx] = (token_subword_embeddings[0] + token_subword_embeddings[-1]) / 2
-            elif subword_pooling_strategy == "max":
-            	# Take the maximum value across subwords
-            	token_embeddings[idx] = token_subword_embeddings.max(dim=0)[0]
-            else:
-                raise ValueError(f"Unknown pooling strategy: {subword_pooling_strategy}")
+            sliding_window_size = tokenizer.model_max_length
+    return sliding_window_size
+
+def get_subword_embeddings_from_tokens_df(text,
+                                          tokens_df,
+                                          tokenizer,
+                                          model,
+                                          sliding_window_size='max',
+                                          mini_batch_size=12,
+                                          sliding_window_overlap=0.5,
+                                          device=None,
+                                          verbose=1):
+    """
+    Runs the encoder over the text, returning the subword embeddings (averaged over overlapping windows)
+    and the CSR alignment of tokens to subwords (see find_subwords_for_tokens), ready to be pooled
+    with get_token_embeddings.
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    sliding_window_size = get_sliding_window_size(tokenizer, sliding_window_size)
 
-    return token_embeddings
+    padding_token_id = int(tokenizer.pad_token_id)
+    subword_ids, subword_offsets = tokenize_text(text, tokenizer)
+    tokens_subword_ids, tokens_subword_ids_offsets = find_subwords_for_tokens(tokens_df, subword_offsets)
+    overlapping_window_boundaries = get_boudaries_list(tokens_df, sub_word_offsets=subword_offsets, sliding_window_size=sliding_window_size, sliding_window_overlap=sliding_window_overlap)
+    subword_embeddings_sum, subword_counts = compute_sub_word_embeddings(overlapping_window_boundaries, subword_ids, model, mini_batch_size=mini_batch_size, padding_token_id=padding_token_id, sliding_window_size=sliding_window_size, device=device, verbose=verbose)
+    # The mean is computed in place, the sum tensor becomes the mean tensor
+    mean_subword_embeddings = average_embeddings_from_overlapping_sliding_windows(subword_embeddings_sum, subword_counts)
+
+    return mean_subword_embeddings, tokens_subword_ids, tokens_subword_ids_offsets
 
 def get_embedding_tensor_from_tokens_df(text,
                                         tokens_df,
@@ -283,34 +617,181 @@ def get_embedding_tensor_from_tokens_df(text,
                                         sliding_window_overlap=0.5,
                                         subword_pooling_strategy="average", # ["average", "first", "last", "first_last", "max"]
                                         device=None,
+                                        embeddings_dtype="float32", # ["float32", "float16"], storage of the returned embeddings
                                         verbose=1):
 
-    if device is None:
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    if sliding_window_size=='max':
-        if tokenizer.model_max_length > 100000:
-            sliding_window_size = 512
-        else:
-            sliding_window_size = tokenizer.model_max_length
-
-
-    padding_token_id = int(tokenizer.pad_token_id)
-    subwords, subword_ids, subword_offsets = tokenize_text(text, tokenizer)
-    tokens_subword_ids = find_subwords_for_tokens(tokens_df, subword_offsets)
-    overlapping_window_boundaries = get_boudaries_list(tokens_df, sub_word_offsets=subword_offsets, sliding_window_size=sliding_window_size, sliding_window_overlap=sliding_window_overlap)
-    subword_indices, all_subword_embeddings = compute_sub_word_embeddings(overlapping_window_boundaries, subword_ids, model, mini_batch_size=mini_batch_size, padding_token_id=padding_token_id, sliding_window_size=sliding_window_size, device=device, verbose=verbose)
-    mean_subword_embeddings = average_embeddings_from_overlapping_sliding_windows(subword_indices, all_subword_embeddings)
-    del all_subword_embeddings
-    gc.collect()
+    mean_subword_embeddings, tokens_subword_ids, tokens_subword_ids_offsets = get_subword_embeddings_from_tokens_df(text,
+                                                                                                                tokens_df,
+                                                                                                                tokenizer,
+                                                                                                                model,
+                                                                                                                sliding_window_size=sliding_window_size,
+                                                                                                                mini_batch_size=mini_batch_size,
+                                                                                                                sliding_window_overlap=sliding_window_overlap,
+                                                                                                                device=device,
+                                                                                                                verbose=verbose)
     tokens_embeddings_tensor = get_token_embeddings(mean_subword_embeddings,
                                                     tokens_subword_ids,
+                                                    tokens_subword_ids_offsets,
                                                     subword_pooling_strategy=subword_pooling_strategy # ["average", "first", "last", "first_last"]
                              )
+    tokens_embeddings_tensor = tokens_embeddings_tensor.to(getattr(torch, embeddings_dtype))
+
+    return tokens_embeddings_tensor
 
-    # tokens_df["subword_ids"] = tokens_subword_ids
-    # tokens_df["subword_offsets"] = tokens_df["subword_ids"].apply(lambda subword_ids: [subword_offsets[i] for i in subword_ids])
-    # tokens_df["subwords"] = tokens_df["subword_ids"].apply(lambda subword_ids: [subwords[i] for i in subword_ids])
+class TokensEmbeddingsProvider:
+    """
+    Token embeddings of one text, shared by every consumer (mentions detection, coreference resolution,
+    attributes classification).
 
+    The encoder runs at most once per base model, and each (base model, subword pooling strategy) tensor is
+    pooled at most once. Encoders are given as {base_model_name: (tokenizer, embedding_model)}; a missing
+    one is loaded on first use with load_tokenizer_and_embedding_model (and added to the dict, so that
+    passing the same dict for the next text reuses it).
+    """
 
-    return tokens_embeddings_tensor
+    def __init__(self, text, tokens_df, encoders,
+                 sliding_window_size='max',
+                 mini_batch_size=12,
+                 sliding_window_overlap=0.5,
+                 embeddings_dtype="float32",
+                 inference_mode="float32",
+                 hidden_layers="last",
+                 backend="torch",
+                 device=None,
+                 verbose=1):
+        self.text = text
+        self.tokens_df = tokens_df
+        self.encoders = encoders
+        self.embedding_settings = {"sliding_window_size": sliding_window_size,
+                                   "mini_batch_size": mini_batch_size,
+                                   "sliding_window_overlap": sliding_window_overlap,
+                                   "device": device,
+                                   "verbose": verbose}
+        self.embeddings_dtype = embeddings_dtype
+        self.inference_mode = inference_mode
+        self.hidden_layers = hidden_layers
+        self.backend = backend
+        self.subword_embeddings = {}
+        self.tokens_embedding_tensors = {}
+
+    def get_encoder(self, base_model_name):
+        if base_model_name not in self.encoders:
+            self.encoders[base_model_name] = load_tokenizer_and_embedding_model(base_model_name,
+                                                                                     inference_mode=self.inference_mode,
+                                                                                     hidden_layers=self.hidden_layers,
+                                                                                     backend=self.backend)
+        return self.encoders[base_model_name]
+
+    def get_tokens_embedding_tensor(self, base_model_name, subword_pooling_strategy="average"):
+        key = (base_model_name, subword_pooling_strategy)
+        if key not in self.tokens_embedding_tensors:
+            if base_model_name not in self.subword_embeddings:
+                tokenizer, embedding_model = self.get_encoder(base_model_name)
+                self.subword_embeddings[base_model_name] = get_subword_embeddings_from_tokens_df(self.text,
+                                                                                                 self.tokens_df,
+                                                                                                 tokenizer,
+                                                                                                 embedding_model,
+                                                                                                 **self.embedding_settings)
+            tokens_embeddings_tensor = get_token_embeddings(*self.subword_embeddings[base_model_name],
+                                                            subword_pooling_strategy=subword_pooling_strategy)
+            self.tokens_embedding_tensors[key] = tokens_embeddings_tensor.to(getattr(torch, self.embeddings_dtype))
+        return self.tokens_embedding_tensors[key]
+
+    def release_subword_embeddings(self, base_model_name=None):
+        # Once every pooling strategy needed from an encoder (from all of them by default) has been computed,
+        # its subword embeddings can be freed
+        if base_model_name is None:
+            self.subword_embeddings = {}
+        else:
+            self.subword_embeddings.pop(base_model_name, None)
+
+class TokensEmbeddingsStore:
+    """
+    Memory-mapped store of per-book token embeddings.
+
+    Embeddings are appended book by book to contiguous float16/float32 shard files, next to an
+    index.json giving the shard, row offset and number of tokens of each book. Reading a book
+    returns a tensor backed by the memory-mapped shard, so that only the pages actually used
+    are loaded in RAM. The store behaves like a read-only dict: store[file_name], file_name in store,
+    store.keys(), len(store).
+    """
 
+    def __init__(self, store_directory, dtype="float32", max_shard_bytes=2**31):
+        self.store_directory = store_directory
+        self.index_path = os.path.join(store_directory, "index.json")
+        os.makedirs(store_directory, exist_ok=True)
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                self.index = json.load(file)
+        else:
+            self.index = {"dtype": str(np.dtype(dtype)),
+                          "hidden_size": None,
+                          "max_shard_bytes": max_shard_bytes,
+                          "shards_rows": [],
+                          "books": {}}
+        self.dtype = np.dtype(self.index["dtype"])
+        self.memmaps = {}
+
+    def get_shard_path(self, shard_ID):
+        return os.path.join(self.store_directory, f"embeddings_{shard_ID:05d}.bin")
+
+    def save_index(self):
+        # Write to a temporary file first, so that an interrupted append never corrupts the index
+        temporary_index_path = f"{self.index_path}.tmp"
+        with open(temporary_index_path, "w", encoding="utf-8") as file:
+            json.dump(self.index, file)
+        os.replace(temporary_index_path, self.index_path)
+
+    def append(self, file_name, tokens_embeddings_tensor):
+        if file_name in self:
+            raise ValueError(f"'{file_name}' is already in the embeddings store.")
+
+        embeddings_array = tokens_embeddings_tensor.detach().cpu().numpy().astype(self.dtype, copy=False)
+        if self.index["hidden_size"] is None:
+            self.index["hidden_size"] = int(embeddings_array.shape[1])
+        elif embeddings_array.shape[1] != self.index["hidden_size"]:
+            raise ValueError(f"Expected embeddings of size {self.index['hidden_size']}, got {embeddings_array.shape[1]}.")
+
+        # Start a new shard when the current one would grow past max_shard_bytes
+        row_bytes = self.index["hidden_size"] * self.dtype.itemsize
+        shards_rows = self.index["shards_rows"]
+        if not shards_rows or (shards_rows[-1] > 0 and (shards_rows[-1] + len(embeddings_array)) * row_bytes > self.index["max_shard_bytes"]):
+            shards_rows.append(0)
+        shard_ID, offset = len(shards_rows) - 1, shards_rows[-1]
+
+        with open(self.get_shard_path(shard_ID), "ab") as file:
+            file.truncate(offset * row_bytes)  # Drop rows left over by an interrupted append
+            file.write(np.ascontiguousarray(embeddings_array).tobytes())
+
+        shards_rows[-1] += len(embeddings_array)
+        self.index["books"][file_name] = [shard_ID, offset, len(embeddings_array)]
+        self.memmaps.pop(shard_ID, None)
+        self.save_index()
+
+    def get_shard_memmap(self, shard_ID):
+        if shard_ID not in self.memmaps:
+            # Copy-on-write mode: tensors can be created without warning, the file is never modified
+            self.memmaps[shard_ID] = np.memmap(self.get_shard_path(shard_ID),
+                                               dtype=self.dtype,
+                                               mode="c",
+                                               shape=(self.index["shards_rows"][shard_ID], self.index["hidden_size"]))
+        return self.memmaps[shard_ID]
+
+    def __getitem__(self, file_name):
+        shard_ID, offset, length = self.index["books"][file_name]
+        if length == 0:
+            return torch.empty((0, self.index["hidden_size"] or 0), dtype=getattr(torch, self.dtype.name))
+        return torch.from_numpy(self.get_shard_memmap(shard_ID)[offset:offset + length])
+
+    def __contains__(self, file_name):
+        return file_name in self.index["books"]
+
+    def __len__(self):
+        return len(self.index["books"])
+
+    def __iter__(self):
+        return iter(self.index["books"])
+
+    def keys(self):
+        return self.index["books"].keys()
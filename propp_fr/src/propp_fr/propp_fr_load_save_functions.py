@@ -3,6 +3,8 @@ import csv
 import re
 import pandas as pd
 import json
+import pickle
+import hashlib
 from pathlib import Path
 
 # Propp_fr - Basic Loading and Saving functions
@@ -30,15 +32,68 @@ def save_text_file(text_content, file_name, files_directory="", extension=".txt"
     with open(text_file_path, 'w', encoding='utf-8') as file:
         file.write(text_content)  # Write the text content to the file
 
-def load_tokens_df(file_name, files_directory="", extension=".tokens"):
+# Columnar binary formats (Parquet / Feather, both need pyarrow) are stored with compact dtypes
+TOKENS_CATEGORICAL_COLUMNS = ["POS_tag", "dependency_relation"]
+ENTITIES_CATEGORICAL_COLUMNS = ["cat", "prop", "gender", "number"]
+BINARY_FILE_FORMATS = ["parquet", "feather"]
+
+def get_file_format(file_path):
+    # Sniff the format from the magic bytes, so that .tokens / .entities files can be loaded whatever their format
+    with open(file_path, "rb") as file:
+        magic_bytes = file.read(6)
+    if magic_bytes.startswith(b"PAR1"):
+        return "parquet"
+    if magic_bytes == b"ARROW1":
+        return "feather"
+    return "tsv"
+
+def get_compact_df(df, categorical_columns):
+    df = df.copy()
+    for column in df.columns:
+        if column in categorical_columns:
+            df[column] = df[column].astype("category")
+        elif pd.api.types.is_integer_dtype(df[column].dtype) and not pd.api.types.is_bool_dtype(df[column].dtype):
+            # IDs and offsets: int32 is enough for the ID and offset ranges of a book (larger values are left as is)
+            if len(df) == 0 or (df[column].min() >= -2**31 and df[column].max() < 2**31):
+                df[column] = df[column].astype("int32")
+    return df
+
+def read_df_file(file_path, file_format=None):
+    if file_format is None:
+        file_format = get_file_format(file_path)
+    if file_format == "parquet":
+        return pd.read_parquet(file_path)
+    if file_format == "feather":
+        return pd.read_feather(file_path)
+    return pd.read_csv(file_path, delimiter='\t', quoting=csv.QUOTE_MINIMAL, keep_default_na=False)
+
+def write_df_file(df, file_path, file_format="tsv", append=False, categorical_columns=()):
+    if file_format in BINARY_FILE_FORMATS:
+        if append:
+            raise ValueError(f"append is only supported for the 'tsv' file format, not '{file_format}'.")
+        df = get_compact_df(df.reset_index(drop=True), categorical_columns)
+        if file_format == "parquet":
+            df.to_parquet(file_path, index=False)
+        else:
+            df.to_feather(file_path)
+    elif file_format == "tsv":
+        # Save the DataFrame as tab-separated values, or append its rows to an existing file
+        if append and os.path.exists(file_path):
+            df.to_csv(file_path, sep='\t', index=False, quoting=csv.QUOTE_MINIMAL, mode='a', header=False)
+        else:
+            df.to_csv(file_path, sep='\t', index=False, quoting=csv.QUOTE_MINIMAL)
+    else:
+        raise ValueError(f"Unknown file_format '{file_format}', expected one of {['tsv'] + BINARY_FILE_FORMATS}.")
+
+def load_tokens_df(file_name, files_directory="", extension=".tokens", file_format=None):
 
     if not file_name.endswith(extension):
         file_name = file_name + extension
 
     tokens_file_path = os.path.join(files_directory, file_name)
-    tokens_df = pd.read_csv(tokens_file_path, delimiter='\t', quoting=csv.QUOTE_MINIMAL, keep_default_na=False)
+    tokens_df = read_df_file(tokens_file_path, file_format=file_format)
     return tokens_df
-def save_tokens_df(tokens_df, file_name, files_directory="", extension=".tokens"):
+def save_tokens_df(tokens_df, file_name, files_directory="", extension=".tokens", append=False, file_format="tsv"):
     # Check if the directory exists, if not, create it
     if not os.path.exists(files_directory):
         os.makedirs(files_directory)
@@ -48,18 +103,17 @@ def save_tokens_df(tokens_df, file_name, files_directory="", extension=".tokens"
         file_name = file_name + extension
     tokens_file_path = os.path.join(files_directory, file_name)
 
-    # Save the DataFrame as a .tokens file
-    tokens_df.to_csv(tokens_file_path, sep='\t', index=False, quoting=csv.QUOTE_MINIMAL)
+    write_df_file(tokens_df, tokens_file_path, file_format=file_format, append=append, categorical_columns=TOKENS_CATEGORICAL_COLUMNS)
 
-def load_entities_df(file_name, files_directory="", extension=".entities"):
+def load_entities_df(file_name, files_directory="", extension=".entities", file_format=None):
 
     if not file_name.endswith(extension):
         file_name = file_name + extension
 
     entities_df_path = os.path.join(files_directory, file_name)
-    entities_df = pd.read_csv(entities_df_path, delimiter='\t', quoting=csv.QUOTE_MINIMAL,  keep_default_na=False)
+    entities_df = read_df_file(entities_df_path, file_format=file_format)
     return entities_df
-def save_entities_df(entities_df, file_name, files_directory="", extension=".entities"):
+def save_entities_df(entities_df, file_name, files_directory="", extension=".entities", append=False, file_format="tsv"):
     # Check if the directory exists, if not, create it
     if not os.path.exists(files_directory):
         os.makedirs(files_directory)
@@ -69,8 +123,7 @@ def save_entities_df(entities_df, file_name, files_directory="", extension=".ent
         file_name = file_name + extension
     entities_file_path = os.path.join(files_directory, file_name)
 
-    # Save the DataFrame as a .tokens file
-    entities_df.to_csv(entities_file_path, sep='\t', index=False, quoting=csv.QUOTE_MINIMAL)
+    write_df_file(entities_df, entities_file_path, file_format=file_format, append=append, categorical_columns=ENTITIES_CATEGORICAL_COLUMNS)
 
 def clean_text(raw_text):
     raw_text = re.sub(r'�', ' ', raw_text)
@@ -119,4 +172,69 @@ def load_sacr_file(file_name, files_directory="", extension=".sacr"):
     sacr_file_path = os.path.join(files_directory, file_name)
     with open(sacr_file_path, 'r', encoding='utf-8') as file:
         sacr_content = file.read()  # Read the entire content of the file
-    return sacr_content
\ No newline at end of file
+    return sacr_content
+
+# Propp_fr - Content-addressed cache for intermediate pipeline stages
+
+def get_cache_key(*key_parts):
+    """
+    Returns a sha256 hex digest identifying a pipeline stage output from its inputs.
+    key_parts can be strings, bytes, numbers or any object with a stable repr (e.g. a dict of settings).
+    """
+    hasher = hashlib.sha256()
+    for key_part in key_parts:
+        if not isinstance(key_part, bytes):
+            key_part = repr(key_part).encode('utf-8')
+        hasher.update(key_part)
+        hasher.update(b'\x00')  # Separator, so that ("ab", "c") and ("a", "bc") differ
+    return hasher.hexdigest()
+
+def update_fingerprint_hasher(hasher, obj):
+    # Models are hashed through their state_dict and tensors through their CPU values, so that the fingerprint
+    # does not depend on the device or the train / eval mode of the models
+    if hasattr(obj, "state_dict"):
+        obj = obj.state_dict()
+    if isinstance(obj, dict):
+        hasher.update(f"dict{len(obj)}".encode('utf-8'))
+        for key in sorted(obj, key=repr):
+            hasher.update(repr(key).encode('utf-8'))
+            update_fingerprint_hasher(hasher, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(f"{type(obj).__name__}{len(obj)}".encode('utf-8'))
+        for item in obj:
+            update_fingerprint_hasher(hasher, item)
+    elif hasattr(obj, "materialize"):  # Uninitialized parameter of a lazy module, it has no values yet
+        hasher.update(type(obj).__name__.encode('utf-8'))
+    elif hasattr(obj, "detach"):  # torch.Tensor
+        hasher.update(f"{obj.dtype}{tuple(obj.shape)}".encode('utf-8'))
+        hasher.update(obj.detach().cpu().float().numpy().tobytes())
+    else:
+        hasher.update(pickle.dumps(obj))
+
+def get_model_fingerprint(model_dict):
+    """
+    Returns a sha256 hex digest of a trained model dict (e.g. a mentions detection or coreference resolution model),
+    stable across devices and train / eval modes. Compute it once after loading the model, not for every file.
+    """
+    hasher = hashlib.sha256()
+    update_fingerprint_hasher(hasher, model_dict)
+    return hasher.hexdigest()
+
+def load_cached_stage(cache_key, stage, cache_directory):
+    """Returns the cached output of a pipeline stage, or None if it has not been cached yet."""
+    cache_file_path = os.path.join(cache_directory, stage, f"{cache_key}.pkl")
+    if not os.path.exists(cache_file_path):
+        return None
+    with open(cache_file_path, "rb") as file:
+        return pickle.load(file)
+
+def save_cached_stage(stage_output, cache_key, stage, cache_directory):
+    stage_directory = os.path.join(cache_directory, stage)
+    os.makedirs(stage_directory, exist_ok=True)
+
+    # Write to a temporary file first, so that concurrent runs never read a partial file
+    cache_file_path = os.path.join(stage_directory, f"{cache_key}.pkl")
+    temporary_file_path = f"{cache_file_path}.{os.getpid()}.tmp"
+    with open(temporary_file_path, "wb") as file:
+        pickle.dump(stage_output, file)
+    os.replace(temporary_file_path, cache_file_path)
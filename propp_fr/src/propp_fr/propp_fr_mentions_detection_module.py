@@ -19,7 +19,7 @@ import gc
 from transformers import AutoConfig
 
 from .propp_fr_load_save_functions import load_tokens_df, load_entities_df, load_text_file
-from .propp_fr_generate_tokens_embeddings_tensor import load_tokenizer_and_embedding_model, get_embedding_tensor_from_tokens_df
+from .propp_fr_generate_tokens_embeddings_tensor import load_tokenizer_and_embedding_model, get_embedding_tensor_from_tokens_df, TokensEmbeddingsStore, get_length_aware_batches
 
 
 #%%
@@ -27,6 +27,7 @@ def get_NER_training_dictionary(files_directory,
                                 NER_training_dictionary_path,
                                 model_name,
                                 subword_pooling_strategy="average",
+                                embeddings_dtype="float32",
                                 verbose=1):
     """
     Generate, save, and load a dictionary for NER training containing token embeddings, token data, and entity data.
@@ -42,6 +43,10 @@ def get_NER_training_dictionary(files_directory,
 
     NER_training_dictionary_path : str
         Path to save/load the serialized dictionary (Pickle format) containing the processed NER data.
+        Token embeddings are stored in a memory-mapped TokensEmbeddingsStore at `{NER_training_dictionary_path}_embeddings`.
+
+    embeddings_dtype : str
+        "float32" or "float16" storage of the token embeddings.
 
     tokenizer : Tokenizer
         A tokenizer compatible with the specified `model`, used for processing tokens.
@@ -55,7 +60,7 @@ def get_NER_training_dictionary(files_directory,
         A dictionary where keys are file names (without extensions) and values are dictionaries containing:
         - "tokens_df": A DataFrame with tokenized data for each file.
         - "entities_df": A DataFrame with entity data for each file.
-        - "tokens_embeddings_tensor": A tensor with token embeddings for each file.
+        - "tokens_embeddings_tensor": A tensor with token embeddings for each file, backed by the memory-mapped store.
     """
 
     # Define the expected file extension for token files
@@ -64,44 +69,57 @@ def get_NER_training_dictionary(files_directory,
     # Extract all .token file names (without the extension) from the directory
     tokens_files = sorted([f.replace(extension, "") for f in os.listdir(files_directory) if f.endswith(extension)])
 
+    # Token embeddings live in a memory-mapped store next to the pickled dictionary,
+    # so that they are read lazily instead of being unpickled all at once
+    tokens_embeddings_store = TokensEmbeddingsStore(f"{NER_training_dictionary_path}_embeddings", dtype=embeddings_dtype)
+
     # If the dictionary doesn't exist, create it
     if not os.path.exists(NER_training_dictionary_path):
         NER_training_dictionary = {}
-        print(f"Loading {model_name} to initialize training dictionary")
-        tokenizer, model = load_tokenizer_and_embedding_model(model_name=model_name)
+        missing_files = [file_name for file_name in tokens_files if file_name not in tokens_embeddings_store]
+        if missing_files:
+            print(f"Loading {model_name} to initialize training dictionary")
+            tokenizer, model = load_tokenizer_and_embedding_model(model_name=model_name)
 
         for file_name in tqdm(tokens_files, desc="Generating Tokens Embeddings"):
-            text = load_text_file(file_name, files_directory)
             tokens_df = load_tokens_df(file_name, files_directory)
             entities_df = load_entities_df(file_name, files_directory)
 
-            tokens_embeddings_tensor = get_embedding_tensor_from_tokens_df(text,
-                                                               tokens_df,
-                                                               tokenizer,
-                                                               model,
-                                                               sliding_window_size='max',
-                                                               mini_batch_size=12,
-                                                               sliding_window_overlap=0.5,
-                                                               subword_pooling_strategy=subword_pooling_strategy, # ["average", "first", "last", "first_last"]
-                                                               device=None,
-                                                               verbose=verbose)
+            if file_name not in tokens_embeddings_store:
+                text = load_text_file(file_name, files_directory)
+                tokens_embeddings_tensor = get_embedding_tensor_from_tokens_df(text,
+                                                                   tokens_df,
+                                                                   tokenizer,
+                                                                   model,
+                                                                   sliding_window_size='max',
+                                                                   mini_batch_size=12,
+                                                                   sliding_window_overlap=0.5,
+                                                                   subword_pooling_strategy=subword_pooling_strategy, # ["average", "first", "last", "first_last"]
+                                                                   device=None,
+                                                                   verbose=verbose)
+                tokens_embeddings_store.append(file_name, tokens_embeddings_tensor)
 
             NER_training_dictionary[file_name] = {"tokens_df": tokens_df,
-                                                  "entities_df": entities_df,
-                                                  "tokens_embeddings_tensor": tokens_embeddings_tensor}
+                                                  "entities_df": entities_df}
 
         with open(NER_training_dictionary_path, "wb") as file:
             pickle.dump(NER_training_dictionary, file)
 
-        # 1. Delete the model
-        del model
-        gc.collect()
-        torch.cuda.empty_cache()
+        if missing_files:
+            # 1. Delete the model
+            del model
+            gc.collect()
+            torch.cuda.empty_cache()
 
     else:
         with open(NER_training_dictionary_path, "rb") as file:
             NER_training_dictionary = pickle.load(file)
 
+    # Dictionaries pickled by previous versions already hold their embeddings
+    for file_name in NER_training_dictionary.keys():
+        if "tokens_embeddings_tensor" not in NER_training_dictionary[file_name]:
+            NER_training_dictionary[file_name]["tokens_embeddings_tensor"] = tokens_embeddings_store[file_name]
+
     return NER_training_dictionary
 
 #%%
@@ -260,6 +278,9 @@ def prepare_NER_dataset(nested_level=0,
         dataset = []
         for sentence_ID, sentence_tokens_df in tokens_df.groupby("sentence_ID"):
             tokens_ids = sentence_tokens_df['token_ID_within_document'].tolist()
+            if tokens_ids[-1] - tokens_ids[0] + 1 == len(tokens_ids):
+                # Contiguous sentence: slice instead of copying, so that memory-mapped embeddings are read only when used
+                tokens_ids = slice(tokens_ids[0], tokens_ids[-1] + 1)
             dataset.append({"embeddings": tokens_embeddings_tensor[tokens_ids],
                             "BIOES_tags": BIOES_tag_ids_tensor[tokens_ids]})
 
@@ -294,7 +315,7 @@ class NERDataset(Dataset):
             tuple: (embeddings, BIOES_tags)
         """
         item = self.dataset[idx]
-        return item["embeddings"], item["BIOES_tags"]
+        return item["embeddings"].float(), item["BIOES_tags"]
 def collate_fn(batch):
     """
     Custom collate function for batching NER data.
@@ -458,6 +479,50 @@ class Highway(nn.Module):
 
         # Highway transformation
         return gate_out * transform_out + (1 - gate_out) * x
+def viterbi_decode(emissions, mask, transitions, start_transitions, end_transitions):
+    """
+    Batched Viterbi decoding of a linear-chain CRF in numpy, returning the same paths as TorchCRF's
+    CRF.viterbi_decode (same float32 additions in the same order, first maximum on ties) without its
+    per-sequence Python backtracking.
+
+    Args:
+        emissions (np.ndarray): Emission scores of shape (batch_size, seq_len, num_labels).
+        mask (np.ndarray): Boolean mask of the (left-aligned) valid tokens, shape (batch_size, seq_len).
+        transitions (np.ndarray): Transition scores from source to destination label, shape (num_labels, num_labels).
+        start_transitions (np.ndarray): Start transition scores, shape (num_labels,).
+        end_transitions (np.ndarray): End transition scores, shape (num_labels,).
+
+    Returns:
+        np.ndarray: Predicted label IDs of shape (batch_size, seq_len), -1 on padding.
+    """
+    batch_size, seq_len, _ = emissions.shape
+    lengths = mask.sum(axis=1)
+    batch_ids = np.arange(batch_size)
+
+    # Forward pass: the best score of each label at each step, and the label it came from
+    scores = np.empty(emissions.shape, dtype=emissions.dtype)
+    backpointers = np.zeros((batch_size, max(seq_len - 1, 0), emissions.shape[2]), dtype=np.int64)
+    scores[:, 0] = start_transitions + emissions[:, 0]
+    for t in range(1, seq_len):
+        step_scores = scores[:, t - 1, :, None] + transitions + emissions[:, t, None, :]
+        backpointers[:, t - 1] = step_scores.argmax(axis=1)
+        scores[:, t] = np.take_along_axis(step_scores, backpointers[:, t - 1, None, :], axis=1)[:, 0]
+
+    # Backtrack every sequence at once, each one starting from the best label of its own last token
+    predicted_labels = np.full((batch_size, seq_len), -1, dtype=np.int64)
+    last_ids = np.maximum(lengths - 1, 0)
+    labels = np.zeros(batch_size, dtype=np.int64)
+    for t in range(seq_len - 1, -1, -1):
+        is_last = last_ids == t
+        labels = np.where(is_last, (scores[batch_ids, t] + end_transitions).argmax(axis=1), labels)
+        is_inside = t <= last_ids
+        predicted_labels[is_inside, t] = labels[is_inside]
+        if t > 0:
+            labels = np.where(is_inside, backpointers[batch_ids, t - 1, labels], labels)
+    predicted_labels[lengths == 0] = -1
+
+    return predicted_labels
+
 class NERModel(nn.Module):
     """
     Named Entity Recognition model with BiLSTM and CRF layers for sequence labeling tasks.
@@ -513,7 +578,8 @@ class NERModel(nn.Module):
     def forward(self,
                 embeddings,
                 attention_mask=None,
-                labels=None
+                labels=None,
+                pack_sequences=False
                 ):
         """
         Forward pass of the NER model.
@@ -522,11 +588,17 @@ class NERModel(nn.Module):
             embeddings (torch.Tensor): Input embeddings of shape (batch_size, seq_len, embedding_dim).
             attention_mask (torch.Tensor, optional): Mask for valid tokens, shape (batch_size, seq_len).
             labels (torch.Tensor, optional): Ground-truth labels, shape (batch_size, seq_len).
+            pack_sequences (bool, optional): Pack the (left-aligned) sequences given by attention_mask before the
+                BiLSTM. Without packing (the default, used for training), the backward LSTM of a padded sequence
+                first runs over its padding, so its outputs depend on the other sequences of the batch. With
+                packing, every sequence gets the outputs of a batch of one (as in get_predicted_entities_df),
+                which can slightly differ from the padded outputs. predict_BIOES_tags packs its batches.
 
         Returns:
             torch.Tensor or tuple:
                 - Training mode: Returns CRF loss (torch.Tensor).
-                - Evaluation mode: Returns predicted labels (list) and confidences (list).
+                - Evaluation mode: Returns predicted labels (long tensor, -1 on padding) and confidences (float tensor,
+                  0 on padding), both of shape (batch_size, seq_len).
         """
         # Apply LockedDropout to embeddings
         embeddings = self.locked_dropout(embeddings)  # Shape: (batch_size, seq_len, embedding_dim)
@@ -535,7 +607,14 @@ class NERModel(nn.Module):
 
         # BiLSTM for sequential context
         self.lstm.flatten_parameters()
-        lstm_out, _ = self.lstm(embeddings)  # Shape: (batch_size, seq_len, hidden_size * 2)
+        if pack_sequences and attention_mask is not None:
+            # The backward LSTM starts on each sequence's last token instead of running over the padding
+            lengths = attention_mask.sum(dim=1).clamp(min=1).cpu()
+            packed_embeddings = rnn.pack_padded_sequence(embeddings, lengths, batch_first=True, enforce_sorted=False)
+            packed_lstm_out, _ = self.lstm(packed_embeddings)
+            lstm_out, _ = rnn.pad_packed_sequence(packed_lstm_out, batch_first=True, total_length=embeddings.size(1))
+        else:
+            lstm_out, _ = self.lstm(embeddings)  # Shape: (batch_size, seq_len, hidden_size * 2)
 
         # Apply LockedDropout to LSTM output
         lstm_out = self.locked_dropout(lstm_out)
@@ -551,21 +630,20 @@ class NERModel(nn.Module):
         else:
             # Decode predictions and compute confidences during inference
             mask = attention_mask.bool()
-            predicted_labels = self.crf.viterbi_decode(logits, mask)
 
-            # Apply softmax to get the probabilities for each label
-            softmax_probs = torch.softmax(logits, dim=-1)
-
-            confidences = []
-            for batch_idx in range(softmax_probs.size(0)):  # Iterate over the batch
-                sentence_predicted_labels = predicted_labels[batch_idx]  # Labels for one sentence
-                sentence_softmax_probs = softmax_probs[batch_idx]  # Probabilities for one sentence
+            # Batched numpy Viterbi with the trained CRF transitions, giving a padded (batch_size, seq_len) label
+            # tensor, -1 on padding like the training labels
+            predicted_labels = viterbi_decode(logits.detach().float().cpu().numpy(),
+                                              mask.cpu().numpy(),
+                                              self.crf.trans_matrix.detach().float().cpu().numpy(),
+                                              self.crf.start_trans.detach().float().cpu().numpy(),
+                                              self.crf.end_trans.detach().float().cpu().numpy())
+            predicted_labels = torch.from_numpy(predicted_labels).to(logits.device)
 
-                sentence_confidences = []  # Store confidences for this sentence
-                for token_idx, label in enumerate(sentence_predicted_labels):  # Iterate over tokens
-                    confidence = sentence_softmax_probs[token_idx, label].item()  # Extract confidence
-                    sentence_confidences.append(confidence)
-                confidences.append(sentence_confidences)  # Append confidences for this sentence
+            # Confidence of each predicted label, gathered from the softmax in one pass (0 on padding)
+            softmax_probs = torch.softmax(logits, dim=-1)
+            confidences = softmax_probs.gather(-1, predicted_labels.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+            confidences = confidences.masked_fill(~mask, 0)
 
             return predicted_labels, confidences
 
@@ -710,6 +788,71 @@ def extract_entities_from_BIO_tag_list(BIO_tag_list):
 
     return entities_df
 
+#%%
+BIOES_TAGS = ["O", "B", "I", "E", "S"]
+
+def get_BIOES_lookup_tables(id2label):
+    """
+    Returns lookup tables from label IDs to their BIOES tag (index in BIOES_TAGS) and category (index in the
+    returned categories list, -1 for "O"), so that predicted label IDs can be decoded without string handling.
+    """
+    categories = sorted({label.split("-", 1)[1] for label in id2label.values() if label != "O"})
+    label_tags = np.zeros(max(id2label) + 1, dtype=np.int64)
+    label_cats = np.full(max(id2label) + 1, -1, dtype=np.int64)
+    for label_id, label in id2label.items():
+        if label != "O":
+            tag, cat = label.split("-", 1)
+            label_tags[label_id] = BIOES_TAGS.index(tag)
+            label_cats[label_id] = categories.index(cat)
+    return label_tags, label_cats, categories
+
+def extract_entities_from_BIOES_label_ids(label_ids, confidences, sentence_starts, id2label):
+    """
+    Vectorized equivalent of remove_BIO_illegal_transitions (applied to each sentence) followed by
+    extract_entities_from_BIO_tag_list, working directly on the flattened predicted label IDs.
+
+    Parameters:
+        label_ids (array-like): Predicted label IDs of all the tokens, sentence after sentence.
+        confidences (array-like): Confidence of each predicted label.
+        sentence_starts (array-like): Position of the first token of each sentence.
+        id2label (dict): Mapping from label IDs to BIOES labels (e.g. {0: "O", 1: "B-PER", ...}).
+
+    Returns:
+        pd.DataFrame: Entities with columns ["start_token", "end_token", "cat", "confidence"], confidence being
+        the mean confidence of the entity tokens.
+    """
+    O, B, I, E, S = range(len(BIOES_TAGS))
+    label_tags, label_cats, categories = get_BIOES_lookup_tables(id2label)
+    label_ids = np.asarray(label_ids, dtype=np.int64)
+    tags, cats = label_tags[label_ids], label_cats[label_ids]
+    positions = np.arange(len(label_ids))
+
+    # An I / E tag continues the previous tag of the sentence if that one is a B / I of the same category
+    continues = np.zeros(len(label_ids), dtype=bool)
+    continues[1:] = np.isin(tags[1:], [I, E]) & np.isin(tags[:-1], [B, I]) & (cats[1:] == cats[:-1])
+    continues[np.asarray(sentence_starts, dtype=np.int64)] = False
+    # A continuation is legal if its chain of continuations starts right after a B, illegal ones are read as "O"
+    chains_heads = np.maximum.accumulate(np.where(continues, 0, positions))
+    inside = continues & (tags[chains_heads] == B)
+
+    # An entity spans its B / S tag and the legal continuations following it
+    start_tokens = np.flatnonzero((tags == B) | (tags == S))
+    next_outside_tokens = np.minimum.accumulate(np.append(np.where(inside, len(positions), positions), len(positions))[::-1])[::-1]
+    end_tokens = next_outside_tokens[start_tokens + 1] - 1
+
+    # Sums over each [start_token, end_token] segment, which unlike differences of a cumulative sum over the
+    # whole book do not lose precision on long books
+    confidences = np.append(np.asarray(confidences, dtype=np.float64), 0)
+    boundaries = np.stack([start_tokens, end_tokens + 1], axis=1).ravel()
+    confidence_sums = np.add.reduceat(confidences, boundaries)[::2] if len(boundaries) else np.zeros(0)
+
+    entities_df = pd.DataFrame({"start_token": start_tokens,
+                                "end_token": end_tokens,
+                                "cat": np.array(categories, dtype=object)[cats[start_tokens]],
+                                "confidence": confidence_sums / (end_tokens + 1 - start_tokens)})
+
+    return entities_df
+
 #%%
 def combine_gold_and_predicted_entities_df(gold_entities_df, predicted_entities_df):
     """
@@ -916,69 +1059,52 @@ def get_predicted_entities_df(NER_model, tokens_df, sentences_embeddings, id2lab
         with torch.no_grad():  # No need to track gradients during inference
             predictions, confidences = NER_model(sentence_embeddings, attention_mask=sentence_attention_mask)
 
-        # Append the predictions and confidences to the respective lists
-        all_predictions += predictions
-        all_confidences += confidences
+        # Append the predictions and confidences of the sentence (batch of one, no padding)
+        all_predictions.append(predictions[0].cpu())
+        all_confidences.append(confidences[0].cpu())
 
-    # Convert predictions to BIO tags using id2label mapping
-    predicted_BIO_tags = [
-        [id2label[id] for id in sequence]
-        for sequence in all_predictions
-    ]
-
-    # Remove illegal transitions in BIO tags
-    legal_predicted_BIO_tags = [remove_BIO_illegal_transitions(sentence) for sentence in predicted_BIO_tags]
-
-    # Flatten the BIO tag sequences for entity extraction
-    flatten_legal_predicted_BIO_tags_predictions = [label for sentence in legal_predicted_BIO_tags for label in
-                                                    sentence]
-
-    # Extract entities from the flattened BIO tag list
-    predicted_entities_df = extract_entities_from_BIO_tag_list(flatten_legal_predicted_BIO_tags_predictions)
-
-    # Flatten the confidences list
-    confidences = [confidence for sequence in all_confidences for confidence in sequence]
-
-    # Calculate the confidence for each predicted entity
-    mentions_confidence = []
-    for start_token, end_token in predicted_entities_df[['start_token', 'end_token']].values:
-        confidence_values = confidences[start_token:end_token + 1]
-        mean_confidence = sum(confidence_values) / len(confidence_values)
-        mentions_confidence.append(mean_confidence)
-
-    # Add the confidence values to the predicted entities DataFrame
-    predicted_entities_df['confidence'] = mentions_confidence
+    # Decode the BIOES label IDs into entities, with their mean confidence
+    sentences_lengths = [len(sequence) for sequence in all_predictions]
+    predicted_entities_df = extract_entities_from_BIOES_label_ids(torch.cat(all_predictions).numpy() if all_predictions else np.zeros(0, dtype=np.int64),
+                                                                  torch.cat(all_confidences).double().numpy() if all_confidences else np.zeros(0),
+                                                                  np.cumsum([0] + sentences_lengths)[:-1],
+                                                                  id2label)
 
     return predicted_entities_df
 
 def remove_overlapping_entities(all_predicted_entities):
+    """
+    Drops every entity whose span duplicates, or crosses (shares some tokens without nesting), the span of an
+    entity that comes before it in the DataFrame order, then removes duplicate rows.
+
+    Crossing pairs are found with a sweep over the entities sorted by start token: the only candidates for an
+    entity are the entities starting strictly inside its span, so the cost is O(n log n) plus the number of
+    such candidates instead of comparing every pair of entities.
+    """
     all_predicted_entities = all_predicted_entities.copy()  # Avoid modifying in place
-    all_predicted_entities["overlapping_boundaries"] = False
 
     start_tokens = all_predicted_entities["start_token"].values
     end_tokens = all_predicted_entities["end_token"].values
-
-    # Create a vectorized mask for overlapping entities
     n = len(all_predicted_entities)
-    overlapping_mask = np.zeros(n, dtype=bool)
 
-    for i in range(n):
-        start, end = start_tokens[i], end_tokens[i]
+    # Identical spans: all but the first occurrence are overlapping
+    overlapping_mask = all_predicted_entities.duplicated(["start_token", "end_token"]).values
+
+    # For each (outer) entity, the (inner) entities starting strictly inside its span, as contiguous runs of the start-sorted order
+    sorted_ids = np.argsort(start_tokens, kind="stable")
+    sorted_start_tokens = start_tokens[sorted_ids]
+    first_inner_positions = np.searchsorted(sorted_start_tokens, start_tokens, side="right")
+    inner_counts = np.maximum(np.searchsorted(sorted_start_tokens, end_tokens, side="left") - first_inner_positions, 0)
 
-        # Vectorized comparison instead of DataFrame filtering
-        higher_ranked_mask = np.arange(n) > i  # Entities ranked higher than i
+    outer_ids = np.repeat(np.arange(n), inner_counts)
+    run_offsets = np.arange(inner_counts.sum()) - np.repeat(np.cumsum(inner_counts) - inner_counts, inner_counts)
+    inner_ids = sorted_ids[np.repeat(first_inner_positions, inner_counts) + run_offsets]
 
-        overlapping_mask |= (
-            higher_ranked_mask
-            & (
-                ((start_tokens < start) & (end_tokens > start) & (end_tokens < end))
-                | ((end_tokens > end) & (start_tokens > start) & (start_tokens < end))
-                | ((start_tokens == start) & (end_tokens == end))
-            )
-        )
+    # An inner entity ending after its outer entity crosses it, the later one of the pair is overlapping
+    crossing = end_tokens[inner_ids] > end_tokens[outer_ids]
+    overlapping_mask[np.maximum(outer_ids[crossing], inner_ids[crossing])] = True
 
-    # Assign overlapping flags in bulk
-    all_predicted_entities.loc[overlapping_mask, "overlapping_boundaries"] = True
+    all_predicted_entities["overlapping_boundaries"] = overlapping_mask
 
     # Filter and remove duplicates
     all_predicted_entities = all_predicted_entities[~all_predicted_entities["overlapping_boundaries"]].drop_duplicates()
@@ -1130,7 +1256,9 @@ def train_NER_model(train_loader=None,
                 predictions, _ = model(embeddings, attention_mask=attention_mask, labels=None)
 
                 # Flatten and remove padding labels
+                predictions = predictions.cpu()
                 for i, prediction in enumerate(predictions):
+                    prediction = prediction[prediction != -1].tolist()  # Remove padding predictions
                     valid_labels = labels[i][:len(prediction)]  # Slice to match prediction length
                     valid_labels = valid_labels[valid_labels != -1]  # Remove padding labels
 
@@ -1392,7 +1520,7 @@ def mentions_detection_LOOCV_full_model_training(files_directory=None,
                 test_data = NER_training_dictionary[file_name]["dataset"]
                 sentences_embeddings = []
                 for sentence_data in test_data:  # Collect embeddings for each sentence in the test file
-                    sentences_embeddings.append(sentence_data["embeddings"])
+                    sentences_embeddings.append(sentence_data["embeddings"].float())
 
                 predicted_entities_dfs = []  # List to store predicted entities for all nested levels
 
@@ -1765,72 +1893,45 @@ def load_mentions_detection_model(model_path="AntoineBourgois/propp-fr_NER_camem
         print(f"An unexpected error occurred: {e}")
         raise
 
-def predict_BIOES_tags(model, sentences_embeddings, batch_size=32, verbose=False):
+def predict_BIOES_tags(model, sentences_embeddings, batch_size=32, verbose=False, max_tokens_per_batch=None):
+    """
+    Predict the BIOES label IDs and confidences of each sentence, returned in input order.
+
+    Sentences are sorted by length and batched under a budget of max_tokens_per_batch tokens (batch_size
+    sentences of the longest length by default), so each batch is only padded to its longest sentence.
+    Batches are packed (see NERModel.forward): the predictions of a sentence do not depend on the batch it is
+    in, and are those of a batch of one sentence, no longer of the padded batches of batch_size sentences.
+    """
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     # Set the model to evaluation mode
     model.eval()
 
-    # Prepare batched inference
-    num_sentences = len(sentences_embeddings)
-    original_lengths = [sentence.size(0) for sentence in sentences_embeddings]  # Track original lengths
-    all_predictions = []
-    all_confidences = []
-
-    if verbose:
-        for i in tqdm(range(0, num_sentences, batch_size), desc="Predicting BIOES tags", leave=False):
-            # Get the current batch of sentence embeddings
-            batch_embeddings = sentences_embeddings[i:i + batch_size]
-
-            # Pad sentences to the same length
-            batch_embeddings_padded = pad_sequence(batch_embeddings,
-                                                   batch_first=True)  # Shape: (batch_size, max_seq_len, embedding_dim)
-
-            # Create attention masks (1 for real tokens, 0 for padding)
-            attention_masks = torch.zeros(batch_embeddings_padded.size()[:2],
-                                          dtype=torch.long)  # Shape: (batch_size, max_seq_len)
-            for j, sentence in enumerate(batch_embeddings):
-                attention_masks[j, :sentence.size(0)] = 1  # Set real tokens to 1
-
-            # Move tensors to the correct device
-            batch_embeddings_padded = batch_embeddings_padded.to(device)
-            attention_masks = attention_masks.to(device)
-
-            # Perform inference
-            with torch.no_grad():
-                predictions, confidences = model(batch_embeddings_padded, attention_mask=attention_masks)
-
-            for j, length in enumerate(original_lengths[i:i + batch_size]):
-                # Extract only the unpadded predictions and confidences
-                all_predictions.append(predictions[j][:length])
-                all_confidences.append(confidences[j][:length])
-    else:
-        for i in range(0, num_sentences, batch_size):
-            # Get the current batch of sentence embeddings
-            batch_embeddings = sentences_embeddings[i:i + batch_size]
-
-            # Pad sentences to the same length
-            batch_embeddings_padded = pad_sequence(batch_embeddings,
-                                                   batch_first=True)  # Shape: (batch_size, max_seq_len, embedding_dim)
+    sentences_lengths = [sentence.size(0) for sentence in sentences_embeddings]
+    if max_tokens_per_batch is None:
+        max_tokens_per_batch = batch_size * max(sentences_lengths, default=1)
+    batches = get_length_aware_batches(sentences_lengths, max_tokens_per_batch)
 
-            # Create attention masks (1 for real tokens, 0 for padding)
-            attention_masks = torch.zeros(batch_embeddings_padded.size()[:2],
-                                          dtype=torch.long)  # Shape: (batch_size, max_seq_len)
-            for j, sentence in enumerate(batch_embeddings):
-                attention_masks[j, :sentence.size(0)] = 1  # Set real tokens to 1
+    # Empty sentences are not batched, they keep empty predictions
+    all_predictions = [torch.zeros(0, dtype=torch.long)] * len(sentences_embeddings)
+    all_confidences = [torch.zeros(0)] * len(sentences_embeddings)
 
-            # Move tensors to the correct device
-            batch_embeddings_padded = batch_embeddings_padded.to(device)
-            attention_masks = attention_masks.to(device)
+    for batch_sentence_ids in tqdm(batches, desc="Predicting BIOES tags", leave=False, disable=not verbose):
+        # Pad the batch to its longest sentence, with a (1 for real tokens, 0 for padding) attention mask
+        batch_embeddings_padded = pad_sequence([sentences_embeddings[i] for i in batch_sentence_ids], batch_first=True)
+        batch_lengths = torch.tensor([sentences_lengths[i] for i in batch_sentence_ids])
+        attention_masks = (torch.arange(batch_embeddings_padded.size(1)) < batch_lengths.unsqueeze(1)).long()
 
-            # Perform inference
-            with torch.no_grad():
-                predictions, confidences = model(batch_embeddings_padded, attention_mask=attention_masks)
+        # Perform inference, moving the outputs to the CPU once per batch
+        with torch.no_grad():
+            predictions, confidences = model(batch_embeddings_padded.to(device), attention_mask=attention_masks.to(device),
+                                             pack_sequences=True)
+        predictions, confidences = predictions.cpu(), confidences.cpu()
 
-            for j, length in enumerate(original_lengths[i:i + batch_size]):
-                # Extract only the unpadded predictions and confidences
-                all_predictions.append(predictions[j][:length])
-                all_confidences.append(confidences[j][:length])
+        # Scatter the unpadded predictions back to the original sentence order
+        for j, sentence_id in enumerate(batch_sentence_ids):
+            all_predictions[sentence_id] = predictions[j, :sentences_lengths[sentence_id]]
+            all_confidences[sentence_id] = confidences[j, :sentences_lengths[sentence_id]]
 
     return all_predictions, all_confidences
 
@@ -1870,34 +1971,13 @@ def generate_entities_df(tokens_df, tokens_embedding_tensor, mentions_detection_
         # Predict BIOES tags and confidences for all sentences in batches
         all_predictions, all_confidences = predict_BIOES_tags(model, sentences_embeddings, batch_size=batch_size, verbose=verbose)
 
-        # Convert prediction IDs to BIOES labels
-        predicted_BIO_tags = [
-            [id2label[id] for id in sequence]
-            for sequence in all_predictions
-        ]
-
-        # Remove illegal transitions in BIOES tags
-        legal_predicted_BIO_tags = [remove_BIO_illegal_transitions(sentence) for sentence in predicted_BIO_tags]
-
-        # Flatten the BIOES tags to prepare for entity extraction
-        flatten_legal_predicted_BIO_tags_predictions = [label for sentence in legal_predicted_BIO_tags for label in
-                                                        sentence]
-
-        # Extract entities based on BIOES tag sequences
-        predicted_entities_df = extract_entities_from_BIO_tag_list(flatten_legal_predicted_BIO_tags_predictions)
-
-        # Flatten the confidence scores for consistency with the flattened tag list
-        confidences = [confidence for sequence in all_confidences for confidence in sequence]
-
-        # Calculate mean confidence for each predicted entity
-        mentions_confidence = []
-        for start_token, end_token in predicted_entities_df[['start_token', 'end_token']].values:
-            confidence_values = confidences[start_token:end_token + 1]
-            mean_confidence = sum(confidence_values) / len(confidence_values)
-            mentions_confidence.append(mean_confidence)
+        # Decode the BIOES label IDs into entities, with their mean confidence
+        sentences_lengths = [len(sequence) for sequence in all_predictions]
+        predicted_entities_df = extract_entities_from_BIOES_label_ids(torch.cat(all_predictions).numpy() if all_predictions else np.zeros(0, dtype=np.int64),
+                                                                      torch.cat(all_confidences).double().numpy() if all_confidences else np.zeros(0),
+                                                                      np.cumsum([0] + sentences_lengths)[:-1],
+                                                                      id2label)
 
-        # Add confidence scores to the predicted entities DataFrame
-        predicted_entities_df['confidence'] = mentions_confidence
         # Append the current model's results to the list of predicted entities DataFrames
         predicted_entities_dfs.append(predicted_entities_df)
 
@@ -5,14 +5,20 @@ import traceback
 import subprocess
 import sys
 import json
+import time
+import numpy as np
+import pandas as pd
+from tqdm.auto import tqdm
 
 from .propp_fr_load_save_functions import load_text_file, clean_text, save_text_file, save_tokens_df, save_entities_df, save_book_file
-from .propp_fr_generate_tokens_df import load_spacy_model, generate_tokens_df
+from .propp_fr_load_save_functions import get_cache_key, get_model_fingerprint, load_cached_stage, save_cached_stage
+from .propp_fr_generate_tokens_df import load_spacy_model, generate_tokens_df, iterate_paragraph_windows_tokens_df, shift_tokens_df
 from .propp_fr_mentions_detection_module import load_mentions_detection_model, generate_entities_df
-from .propp_fr_coreference_resolution_module import load_coreference_resolution_model,perform_coreference
-from .propp_fr_generate_tokens_embeddings_tensor import get_embedding_tensor_from_tokens_df, load_tokenizer_and_embedding_model
-from .propp_fr_add_entities_features import add_features_to_entities
+from .propp_fr_coreference_resolution_module import load_coreference_resolution_model,perform_coreference, get_mentions_embeddings
+from .propp_fr_generate_tokens_embeddings_tensor import TokensEmbeddingsProvider, load_tokenizer_and_embedding_model
+from .propp_fr_add_entities_features import add_features_to_entities, assign_mention_head_id
 from .propp_fr_extract_attributes import extract_attributes
+from .propp_fr_classify_attributes import ATTRIBUTE_COLUMNS, load_ontology_classification_model, classify_attributes
 from .propp_fr_generate_characters_dict import generate_characters_dict
 
 def install_spacy_for_cuda():
@@ -97,6 +103,29 @@ def load_models(spacy_model_name="fr_dep_news_trf",
     return spacy_model, mentions_detection_model, coreference_resolution_model
 
 
+def get_spacy_model_name(spacy_model):
+    meta = spacy_model.meta
+    return f"{meta.get('lang', '')}_{meta.get('name', '')}-{meta.get('version', '')}"
+
+
+def run_cached_stage(stage, cache_key, cache_directory, compute_stage, verbose=1):
+    """
+    Returns the cached output of a pipeline stage if it exists, otherwise computes and caches it.
+    If cache_directory is None, the stage is always computed.
+    """
+    if cache_directory is None:
+        return compute_stage()
+
+    stage_output = load_cached_stage(cache_key, stage, cache_directory)
+    if stage_output is not None:
+        if verbose: print(f"Loaded cached {stage} ({cache_key[:12]})")
+        return stage_output
+
+    stage_output = compute_stage()
+    save_cached_stage(stage_output, cache_key, stage, cache_directory)
+    return stage_output
+
+
 def process_file(file_name,
                  input_folder,
                  output_folder,
@@ -105,95 +134,356 @@ def process_file(file_name,
                  coreference_resolution_model,
                  tokenizer, embedding_model,
                  spacy_max_characters_batch=1000000,
+                 spacy_n_process=1,
                  embedding_mini_batch=64,
                  mentions_detection_batch=14,
                  coreference_resolution_batch=50000,
+                 coreference_tokenizer=None,
+                 coreference_embedding_model=None,
+                 propagate_coref=True,
+                 rule_based_postprocess=False,
+                 cache_directory=None,
+                 file_format="tsv",
+                 embeddings_dtype="float32",
+                 attributes_classification_model=None,
+                 mentions_detection_model_fingerprint=None,
+                 coreference_resolution_model_fingerprint=None,
                  verbose=1
                  ):
     """
     Process a single text and save outputs to the specified folder.
+
+    Token embeddings are computed by a TokensEmbeddingsProvider: the encoder runs at most once per
+    embedding model and each (embedding model, subword pooling) tensor is shared by mentions detection,
+    coreference resolution and attributes classification. If the coreference model does not share the
+    mentions detection embedding model, the coreference tokenizer and embedding model can be passed to
+    avoid reloading them for each file.
+
+    If attributes_classification_model is given (see load_ontology_classification_model), the extracted
+    character attributes are classified, and the predictions saved in the .tokens file.
+
+    With spacy_n_process > 1 (CPU only), spaCy parses paragraph-aligned samples of the text in parallel.
+
+    If cache_directory is given, the tokens_df, the token embeddings, the entities_df and the
+    coreference output are cached there, keyed on a hash of the cleaned text and of the models and
+    settings used to produce them. Re-running with different coreference settings then reuses the
+    spaCy, embedding and mentions detection stages.
+    The models are identified by mentions_detection_model_fingerprint and coreference_resolution_model_fingerprint
+    (see get_model_fingerprint): when processing several files, compute them once and pass them here,
+    otherwise they are computed for this file.
+
+    file_format sets the format of the .tokens and .entities files: "tsv" (default), or the columnar
+    "parquet" / "feather" formats (need pyarrow), which load much faster for corpus-wide statistics.
+
+    embeddings_dtype="float16" halves the memory (and cache size) of the token embeddings. The encoder precision
+    itself is set when loading it, see load_tokenizer_and_embedding_model(inference_mode=...).
+
+    Returns a dict with the number of characters, tokens and entities of the processed text.
     """
 
+    if cache_directory is not None:
+        if mentions_detection_model_fingerprint is None:
+            mentions_detection_model_fingerprint = get_model_fingerprint(mentions_detection_model)
+        if coreference_resolution_model_fingerprint is None:
+            coreference_resolution_model_fingerprint = get_model_fingerprint(coreference_resolution_model)
+
     # Process the file
     txt_content = load_text_file(file_name, files_directory=input_folder)
     txt_content = clean_text(txt_content)
-    tokens_df = generate_tokens_df(txt_content,
-                                   spacy_model,
-                                   max_char_sentence_length=spacy_max_characters_batch
-                                   )
-
-    # Generate token embeddings
-    if verbose: print("Generating token embeddings...")
-    tokens_embedding_tensor = get_embedding_tensor_from_tokens_df(txt_content,
-                                                                  tokens_df,
-                                                                  tokenizer,
-                                                                  embedding_model,
-                                                                  sliding_window_size='max',
-                                                                  mini_batch_size=embedding_mini_batch,
-                                                                  sliding_window_overlap=0.5,
-                                                                  subword_pooling_strategy=mentions_detection_model[
-                                                                      "subword_pooling_strategy"])
-
-    if verbose: print("Mentions Detection...")
-    entities_df = generate_entities_df(tokens_df,
-                                       tokens_embedding_tensor,
-                                       mentions_detection_model,
-                                       batch_size=mentions_detection_batch
-                                       )
-
-    entities_df = add_features_to_entities(entities_df, tokens_df)
 
-    # Perform Coreference Resolution
-    if coreference_resolution_model["base_model_name"] != mentions_detection_model["base_model_name"]:
-        tokenizer, embedding_model = load_tokenizer_and_embedding_model(coreference_resolution_model["base_model_name"])
-        tokens_embedding_tensor = get_embedding_tensor_from_tokens_df(txt_content,
-                                                                      tokens_df,
-                                                                      tokenizer,
-                                                                      embedding_model,
-                                                                      sliding_window_size='max',
-                                                                      mini_batch_size=embedding_mini_batch,
-                                                                      sliding_window_overlap=0.5,
-                                                                      subword_pooling_strategy=mentions_detection_model[
-                                                                          "subword_pooling_strategy"])
+    tokens_cache_key = get_cache_key(txt_content, get_spacy_model_name(spacy_model), spacy_max_characters_batch,
+                                     spacy_n_process != 1)
+    tokens_df = run_cached_stage("tokens", tokens_cache_key, cache_directory,
+                                 lambda: generate_tokens_df(txt_content,
+                                                            spacy_model,
+                                                            max_char_sentence_length=spacy_max_characters_batch,
+                                                            n_process=spacy_n_process
+                                                            ),
+                                 verbose=verbose)
+
+    embedding_settings = {"sliding_window_size": 'max',
+                          "sliding_window_overlap": 0.5,
+                          "subword_pooling_strategy": mentions_detection_model["subword_pooling_strategy"],
+                          "embeddings_dtype": embeddings_dtype}
+    embedding_inference_mode = getattr(embedding_model, "embedding_inference_mode", "float32")
+    embedding_hidden_layers = getattr(embedding_model, "embedding_hidden_layers", "last")
+    embedding_backend = getattr(embedding_model, "embedding_backend", "torch")
+
+    encoders = {mentions_detection_model["base_model_name"]: (tokenizer, embedding_model)}
+    if coreference_tokenizer is not None and coreference_embedding_model is not None:
+        encoders.setdefault(coreference_resolution_model["base_model_name"], (coreference_tokenizer, coreference_embedding_model))
+    embeddings_provider = TokensEmbeddingsProvider(txt_content,
+                                                   tokens_df,
+                                                   encoders,
+                                                   sliding_window_size=embedding_settings["sliding_window_size"],
+                                                   mini_batch_size=embedding_mini_batch,
+                                                   sliding_window_overlap=embedding_settings["sliding_window_overlap"],
+                                                   embeddings_dtype=embeddings_dtype,
+                                                   inference_mode=embedding_inference_mode,
+                                                   hidden_layers=embedding_hidden_layers,
+                                                   backend=embedding_backend,
+                                                   verbose=verbose)
+    tokens_embedding_tensors = {}
+
+    mentions_detection_embedding = (mentions_detection_model["base_model_name"], mentions_detection_model["subword_pooling_strategy"])
+    coreference_embedding = (coreference_resolution_model["base_model_name"],
+                             coreference_resolution_model.get("subword_pooling_strategy", mentions_detection_model["subword_pooling_strategy"]))
+    # The attributes classifier is trained on the mentions detection embeddings, unless its model dict says otherwise
+    attributes_embedding = None
+    if attributes_classification_model is not None:
+        attributes_embedding = (attributes_classification_model.get("base_model_name", mentions_detection_model["base_model_name"]),
+                                attributes_classification_model.get("subword_pooling_strategy", mentions_detection_model["subword_pooling_strategy"]))
+    # Token embeddings needed by the next stages: once they are all pooled for an encoder, its subword embeddings are freed
+    pending_embeddings = [mentions_detection_embedding, coreference_embedding] + ([attributes_embedding] if attributes_embedding else [])
+
+    def complete_embeddings_stage(embedding):
+        pending_embeddings.remove(embedding)
+        if all(pending_embedding[0] != embedding[0] or pending_embedding in tokens_embedding_tensors
+               for pending_embedding in pending_embeddings):
+            embeddings_provider.release_subword_embeddings(embedding[0])
+
+    def get_tokens_embedding_tensor(base_model_name, subword_pooling_strategy):
+        # Loaded from the cache, or computed by the provider, at most once per (embedding model, pooling)
+        if (base_model_name, subword_pooling_strategy) not in tokens_embedding_tensors:
+            embeddings_cache_key = get_cache_key(tokens_cache_key, base_model_name,
+                                                 {**embedding_settings, "subword_pooling_strategy": subword_pooling_strategy},
+                                                 embedding_inference_mode,
+                                                 embedding_hidden_layers,
+                                                 embedding_backend)
+
+            def compute_embeddings():
+                if verbose: print("Generating token embeddings...")
+                return embeddings_provider.get_tokens_embedding_tensor(base_model_name, subword_pooling_strategy)
+
+            tokens_embedding_tensors[(base_model_name, subword_pooling_strategy)] = run_cached_stage("embeddings", embeddings_cache_key,
+                                                                                                     cache_directory, compute_embeddings,
+                                                                                                     verbose=verbose)
+        return tokens_embedding_tensors[(base_model_name, subword_pooling_strategy)]
+
+    def compute_entities():
+        tokens_embedding_tensor = get_tokens_embedding_tensor(*mentions_detection_embedding)
+        if verbose: print("Mentions Detection...")
+        entities_df = generate_entities_df(tokens_df,
+                                           tokens_embedding_tensor,
+                                           mentions_detection_model,
+                                           batch_size=mentions_detection_batch
+                                           )
+        return add_features_to_entities(entities_df, tokens_df)
+
+    entities_cache_key = get_cache_key(tokens_cache_key,
+                                       mentions_detection_model["base_model_name"],
+                                       embedding_settings,
+                                       embedding_inference_mode,
+                                       embedding_hidden_layers,
+                                       embedding_backend,
+                                       mentions_detection_model_fingerprint)
+    entities_df = run_cached_stage("entities", entities_cache_key, cache_directory, compute_entities,
+                                   verbose=verbose)
+    complete_embeddings_stage(mentions_detection_embedding)
 
-    if verbose: print("Coreference Resolution...")
-    entities_df = perform_coreference(entities_df=entities_df,
-                                      tokens_embedding_tensor=tokens_embedding_tensor,
-                                      coreference_resolution_model=coreference_resolution_model,
-                                      batch_size=coreference_resolution_batch,
-                                      propagate_coref=True,
-                                      rule_based_postprocess=False)
+    # Perform Coreference Resolution
+    def compute_coreference():
+        tokens_embedding_tensor = get_tokens_embedding_tensor(*coreference_embedding)
+
+        if verbose: print("Coreference Resolution...")
+        return perform_coreference(entities_df=entities_df.copy(),
+                                   tokens_embedding_tensor=tokens_embedding_tensor,
+                                   coreference_resolution_model=coreference_resolution_model,
+                                   batch_size=coreference_resolution_batch,
+                                   propagate_coref=propagate_coref,
+                                   rule_based_postprocess=rule_based_postprocess)
+
+    coreference_cache_key = get_cache_key(entities_cache_key,
+                                          coreference_resolution_model["base_model_name"],
+                                          coreference_resolution_model_fingerprint,
+                                          {"propagate_coref": propagate_coref,
+                                           "rule_based_postprocess": rule_based_postprocess})
+    entities_df = run_cached_stage("coreference", coreference_cache_key, cache_directory, compute_coreference,
+                                   verbose=verbose)
+    complete_embeddings_stage(coreference_embedding)
 
     # Extract character attributes
     tokens_df = extract_attributes(entities_df, tokens_df)
+    if attributes_classification_model is not None:
+        if verbose: print("Attributes Classification...")
+        tokens_df = classify_attributes(tokens_df, get_tokens_embedding_tensor(*attributes_embedding), attributes_classification_model)
+        complete_embeddings_stage(attributes_embedding)
     characters_dict = generate_characters_dict(tokens_df, entities_df)
 
     # Save all files
     save_text_file(txt_content, file_name, files_directory=output_folder)
-    save_tokens_df(tokens_df, file_name, files_directory=output_folder)
-    save_entities_df(entities_df, file_name, files_directory=output_folder)
+    save_tokens_df(tokens_df, file_name, files_directory=output_folder, file_format=file_format)
+    save_entities_df(entities_df, file_name, files_directory=output_folder, file_format=file_format)
+
+    save_book_file(characters_dict, file_name, files_directory=output_folder)
+
+    return {"characters": len(txt_content),
+            "tokens": len(tokens_df),
+            "entities": len(entities_df)}
+
+
+def process_file_streaming(file_name,
+                           input_folder,
+                           output_folder,
+                           spacy_model,
+                           mentions_detection_model,
+                           coreference_resolution_model,
+                           tokenizer, embedding_model,
+                           window_length=200000,
+                           spacy_max_characters_batch=50000,
+                           embedding_mini_batch=64,
+                           mentions_detection_batch=14,
+                           coreference_resolution_batch=50000,
+                           coreference_tokenizer=None,
+                           coreference_embedding_model=None,
+                           propagate_coref=True,
+                           rule_based_postprocess=False,
+                           embeddings_dtype="float32",
+                           attributes_classification_model=None,
+                           verbose=1
+                           ):
+    """
+    Bounded-memory variant of process_file for very long texts (multi-volume works).
+
+    The text is processed one paragraph-aligned window of about window_length characters at a time:
+    spaCy parsing, token embeddings, mentions detection and attributes extraction only hold one window,
+    and the window tokens are appended to the .tokens file as soon as they are processed.
+    Only the mention embeddings needed by coreference resolution, the tokens inside mentions (for the entity
+    features) and the attribute-bearing tokens (for the .book file) are kept until the end of the text,
+    where coreference resolution is performed on the whole book and the .entities and .book files are written.
+
+    Each window gets its own TokensEmbeddingsProvider, shared by mentions detection, coreference resolution
+    and attributes classification (see process_file).
 
+    Returns a dict with the number of characters, tokens and entities of the processed text.
+    """
+    txt_content = load_text_file(file_name, files_directory=input_folder)
+    txt_content = clean_text(txt_content)
+    save_text_file(txt_content, file_name, files_directory=output_folder)
+
+    embedding_inference_mode = getattr(embedding_model, "embedding_inference_mode", "float32")
+    encoders = {mentions_detection_model["base_model_name"]: (tokenizer, embedding_model)}
+    if coreference_tokenizer is not None and coreference_embedding_model is not None:
+        encoders.setdefault(coreference_resolution_model["base_model_name"], (coreference_tokenizer, coreference_embedding_model))
+    # A missing encoder is loaded by the first window provider, and reused by the next ones through the encoders dict
+    embedding_settings = {"sliding_window_size": 'max',
+                          "mini_batch_size": embedding_mini_batch,
+                          "sliding_window_overlap": 0.5,
+                          "embeddings_dtype": embeddings_dtype,
+                          "inference_mode": embedding_inference_mode,
+                          "hidden_layers": getattr(embedding_model, "embedding_hidden_layers", "last"),
+                          "backend": getattr(embedding_model, "embedding_backend", "torch"),
+                          "verbose": 0}
+    coreference_embedding = (coreference_resolution_model["base_model_name"],
+                             coreference_resolution_model.get("subword_pooling_strategy", mentions_detection_model["subword_pooling_strategy"]))
+    if attributes_classification_model is not None:
+        attributes_embedding = (attributes_classification_model.get("base_model_name", mentions_detection_model["base_model_name"]),
+                                attributes_classification_model.get("subword_pooling_strategy", mentions_detection_model["subword_pooling_strategy"]))
+
+    entities_dfs, mention_tokens_dfs, attribute_tokens_dfs = [], [], []
+    mentions_embeddings, mentions_spans = [], []
+    tokens_count = 0
+    windows = iterate_paragraph_windows_tokens_df(txt_content, spacy_model,
+                                                  window_length=window_length,
+                                                  max_char_sentence_length=spacy_max_characters_batch,
+                                                  verbose=0)
+    for window_text, window_tokens_df, shift in tqdm(windows, desc="Processing Text Windows", leave=False,
+                                                     disable=(verbose == 0)):
+        # Token IDs and byte offsets are relative to the window until the window tokens are shifted
+        embeddings_provider = TokensEmbeddingsProvider(window_text, window_tokens_df, encoders, **embedding_settings)
+        window_entities_df = generate_entities_df(window_tokens_df,
+                                                  embeddings_provider.get_tokens_embedding_tensor(mentions_detection_model["base_model_name"],
+                                                                                                  mentions_detection_model["subword_pooling_strategy"]),
+                                                  mentions_detection_model,
+                                                  batch_size=mentions_detection_batch)
+
+        # Keep only the embeddings of the mentions considered for coreference resolution
+        CAT_window_entities_df = window_entities_df[window_entities_df["cat"].isin(coreference_resolution_model["entity_types"])]
+        if len(CAT_window_entities_df) > 0:
+            mentions_embeddings.append(get_mentions_embeddings(CAT_window_entities_df,
+                                                               embeddings_provider.get_tokens_embedding_tensor(*coreference_embedding)))
+            mentions_spans.append(CAT_window_entities_df[["start_token", "end_token"]].to_numpy() + shift["token_ID_within_document"])
+
+        # Character attributes only link tokens of the same sentence, they can be extracted window by window
+        window_entities_df["mention_len"] = window_entities_df["end_token"] + 1 - window_entities_df["start_token"]
+        window_tokens_df = extract_attributes(assign_mention_head_id(window_entities_df, window_tokens_df),
+                                              window_tokens_df)
+        if attributes_classification_model is not None:
+            window_tokens_df = classify_attributes(window_tokens_df,
+                                                   embeddings_provider.get_tokens_embedding_tensor(*attributes_embedding),
+                                                   attributes_classification_model)
+        del embeddings_provider
+
+        # Move the window tokens and entities to document IDs
+        token_shift = shift["token_ID_within_document"]
+        window_tokens_df = shift_tokens_df(window_tokens_df, shift)
+        for attribute_column in ATTRIBUTE_COLUMNS:
+            window_tokens_df.loc[window_tokens_df[attribute_column] != -1, attribute_column] += token_shift
+        window_tokens_df.index = window_tokens_df["token_ID_within_document"].to_numpy()
+        # Lemmas are lowercased, as generate_characters_dict does on the tokens_df saved by process_file
+        window_tokens_df['lemma'] = window_tokens_df['lemma'].str.lower()
+        window_entities_df = window_entities_df[["start_token", "end_token", "cat", "confidence", "text"]].copy()
+        window_entities_df[["start_token", "end_token"]] += token_shift
+
+        save_tokens_df(window_tokens_df, file_name, files_directory=output_folder, append=(tokens_count > 0))
+        tokens_count += len(window_tokens_df)
+
+        # Tokens inside mentions, found with a +1 / -1 difference array over the mention boundaries
+        mention_boundaries = np.zeros(len(window_tokens_df) + 1, dtype=np.int64)
+        np.add.at(mention_boundaries, window_entities_df["start_token"].to_numpy() - token_shift, 1)
+        np.add.at(mention_boundaries, window_entities_df["end_token"].to_numpy() + 1 - token_shift, -1)
+        mention_tokens_dfs.append(window_tokens_df[np.cumsum(mention_boundaries)[:-1] > 0])
+        attribute_tokens_dfs.append(window_tokens_df[(window_tokens_df[ATTRIBUTE_COLUMNS] != -1).any(axis=1)])
+        entities_dfs.append(window_entities_df)
+        del window_tokens_df
+
+    entities_df = pd.concat(entities_dfs, ignore_index=True)
+    mention_tokens_df = pd.concat(mention_tokens_dfs)
+    attribute_tokens_df = pd.concat(attribute_tokens_dfs)
+    del entities_dfs, mention_tokens_dfs, attribute_tokens_dfs
+
+    # Some entity features (proper mentions, gender) are propagated at the book level
+    entities_df = add_features_to_entities(entities_df, mention_tokens_df)
+    del mention_tokens_df
+
+    # Align the mention embeddings, computed in window order, with the coreference entities
+    CAT_entities_df = entities_df[entities_df["cat"].isin(coreference_resolution_model["entity_types"])]
+    if len(mentions_embeddings) > 0:
+        mentions_spans = np.concatenate(mentions_spans)
+        mentions_spans_df = pd.DataFrame({"start_token": mentions_spans[:, 0],
+                                          "end_token": mentions_spans[:, 1],
+                                          "embedding_row": np.arange(len(mentions_spans))})
+        embedding_rows = CAT_entities_df[["start_token", "end_token"]].merge(mentions_spans_df,
+                                                                             on=["start_token", "end_token"],
+                                                                             how="left")["embedding_row"].to_numpy()
+        mentions_embeddings_tensor = torch.cat(mentions_embeddings)[embedding_rows]
+    else:
+        mentions_embeddings_tensor = torch.empty(0)
+    del mentions_embeddings
+
+    if verbose: print("Coreference Resolution...")
+    entities_df = perform_coreference(entities_df=entities_df,
+                                      coreference_resolution_model=coreference_resolution_model,
+                                      batch_size=coreference_resolution_batch,
+                                      propagate_coref=propagate_coref,
+                                      rule_based_postprocess=rule_based_postprocess,
+                                      mentions_embeddings_tensor=mentions_embeddings_tensor)
+
+    characters_dict = generate_characters_dict(attribute_tokens_df, entities_df)
+
+    save_entities_df(entities_df, file_name, files_directory=output_folder)
     save_book_file(characters_dict, file_name, files_directory=output_folder)
 
+    return {"characters": len(txt_content),
+            "tokens": tokens_count,
+            "entities": len(entities_df)}
+
 
 def process_text_file(txt_file_path):
     if not os.path.isfile(txt_file_path):
         print(f"File {txt_file_path} does not exist.")
 
     else:
-        spacy_model_name = "fr_dep_news_trf"
-        spacy_input_max_length = 500000
-
-        print("Loading models...")
-        if torch.cuda.is_available():
-            spacy.prefer_gpu()  # prefer
-            spacy_model = spacy.load(spacy_model_name)
-            print("CUDA is available, Spacy model should run on GPU.")
-        else:
-            spacy_model = load_spacy_model(model_name=spacy_model_name, model_max_length=spacy_input_max_length)
-            print("CUDA is not available, Spacy model will run on CPU.")
-        spacy_model.max_length = spacy_input_max_length
-
         # Split into directory and file name
         input_folder = os.path.dirname(txt_file_path)
         file_name = os.path.basename(txt_file_path)
@@ -204,38 +494,18 @@ def process_text_file(txt_file_path):
         # Create the output folder if it doesn't exist
         os.makedirs(output_folder, exist_ok=True)
 
-        # 1. Loading Models
-        spacy_model, mentions_detection_model, coreference_resolution_model = load_models(
-            spacy_model_name="fr_dep_news_trf",
-            mentions_detection_model_name = "AntoineBourgois/propp-fr_NER_camembert-large_FAC_GPE_LOC_PER_TIME_VEH",
-            # mentions_detection_model_name="AntoineBourgois/propp-fr_NER_camembert-large_PER",
-            coreference_resolution_model_name="AntoineBourgois/propp-fr_coreference-resolution_camembert-large_PER",
-            force_download=False)
-        tokenizer, embedding_model = load_tokenizer_and_embedding_model(mentions_detection_model["base_model_name"])
-
         if os.path.exists(os.path.join(output_folder, f"{file_name}.book")):
             print(f"{file_name}.book already exists. Skipping...")
 
         else:
-            process_file(file_name,
-                         input_folder,
-                         output_folder,
-                         spacy_model,
-                         mentions_detection_model,
-                         coreference_resolution_model,
-                         tokenizer, embedding_model,
-                         verbose=1,
-                         spacy_max_characters_batch=50000,
-                         embedding_mini_batch=10,
-                         mentions_detection_batch=12,
-                         coreference_resolution_batch=50000,
-
-                         # spacy_max_characters_batch=1000000,
-                         # embedding_mini_batch=64,
-                         # mentions_detection_batch=128,
-                         # coreference_resolution_batch=50000,
-
-                         )
+            # 1. Loading Models
+            spacy_model, mentions_detection_model, coreference_resolution_model = load_models(
+                spacy_model_name="fr_dep_news_trf",
+                mentions_detection_model_name = "AntoineBourgois/propp-fr_NER_camembert-large_FAC_GPE_LOC_PER_TIME_VEH",
+                # mentions_detection_model_name="AntoineBourgois/propp-fr_NER_camembert-large_PER",
+                coreference_resolution_model_name="AntoineBourgois/propp-fr_coreference-resolution_camembert-large_PER",
+                force_download=False)
+            tokenizer, embedding_model = load_tokenizer_and_embedding_model(mentions_detection_model["base_model_name"])
 
             try:
                 process_file(file_name,
@@ -260,3 +530,160 @@ def process_text_file(txt_file_path):
             except Exception as e:
                 print(f"⚠️ Unexpected error processing file {file_name}: {e}")
                 traceback.print_exc()  # <- prints the full traceback
+
+
+def process_directory(input_folder,
+                      output_folder=None,
+                      spacy_model_name="fr_dep_news_trf",
+                      mentions_detection_model_name="AntoineBourgois/propp-fr_NER_camembert-large_FAC_GPE_LOC_PER_TIME_VEH",
+                      coreference_resolution_model_name="AntoineBourgois/propp-fr_coreference-resolution_camembert-large_PER",
+                      spacy_max_characters_batch=50000,
+                      spacy_n_process=1,
+                      embedding_mini_batch=10,
+                      mentions_detection_batch=12,
+                      coreference_resolution_batch=50000,
+                      force_download=False,
+                      cache_directory=None,
+                      file_format="tsv",
+                      streaming_window_length=None,
+                      embedding_inference_mode="float32",
+                      embeddings_dtype="float32",
+                      attributes_classification=False,
+                      embedding_hidden_layers="last",
+                      embedding_backend="torch",
+                      embedding_num_threads=None,
+                      compile_encoder=False,
+                      verbose=1):
+    """
+    Process all the .txt files of a directory, loading spaCy, the embedding model(s)
+    and the mentions detection / coreference resolution models only once.
+
+    Files whose .book output already exists in output_folder are skipped.
+    If cache_directory is given, intermediate stages are cached there (see process_file).
+    file_format sets the format of the .tokens and .entities files (see process_file).
+    If streaming_window_length is given, files are processed with bounded memory, one window of about
+    streaming_window_length characters at a time (see process_file_streaming); stages are then not cached
+    and the .tokens file, written incrementally, is always tab-separated.
+    embedding_inference_mode ("float32", "bfloat16" or "int8") sets the precision of the encoder, see
+    load_tokenizer_and_embedding_model, and embeddings_dtype the storage of the token embeddings (see process_file).
+    embedding_hidden_layers selects the encoder layers used as token embeddings, see load_tokenizer_and_embedding_model
+    (the pretrained mentions detection and coreference models expect the default, "last").
+    embedding_backend="onnx" runs the encoder with ONNX Runtime on CPU, see load_tokenizer_and_embedding_model.
+    embedding_num_threads sets the encoder intra-op threads on CPU (ONNX Runtime or torch).
+    compile_encoder=True compiles the PyTorch encoder for static (embedding_mini_batch, sliding window) batches
+    and warms it up before the first file, see load_tokenizer_and_embedding_model.
+    If attributes_classification is True, the character attributes are classified with the default
+    load_ontology_classification_model, reusing the token embeddings of mentions detection.
+
+    Returns a DataFrame with the processing time and throughput of each processed file.
+    """
+    if output_folder is None:
+        output_folder = input_folder
+    os.makedirs(output_folder, exist_ok=True)
+
+    txt_files = sorted(os.path.splitext(f)[0] for f in os.listdir(input_folder) if f.endswith(".txt"))
+    unprocessed_files = [file_name for file_name in txt_files
+                         if not os.path.exists(os.path.join(output_folder, f"{file_name}.book"))]
+    print(f"Unprocessed Files: {len(unprocessed_files):,} / {len(txt_files):,}")
+
+    columns = ["file_name", "characters", "tokens", "entities", "seconds", "tokens_per_second", "status"]
+    if len(unprocessed_files) == 0:
+        return pd.DataFrame(columns=columns)
+
+    # Load models once for the whole corpus
+    spacy_model, mentions_detection_model, coreference_resolution_model = load_models(
+        spacy_model_name=spacy_model_name,
+        mentions_detection_model_name=mentions_detection_model_name,
+        coreference_resolution_model_name=coreference_resolution_model_name,
+        force_download=force_download)
+    encoder_settings = {"inference_mode": embedding_inference_mode,
+                        "hidden_layers": embedding_hidden_layers,
+                        "backend": embedding_backend,
+                        "intra_op_num_threads": embedding_num_threads,
+                        "compile_encoder": compile_encoder,
+                        "compiled_batch_size": embedding_mini_batch}
+    tokenizer, embedding_model = load_tokenizer_and_embedding_model(mentions_detection_model["base_model_name"],
+                                                                    **encoder_settings)
+    coreference_tokenizer, coreference_embedding_model = None, None
+    if coreference_resolution_model["base_model_name"] != mentions_detection_model["base_model_name"]:
+        coreference_tokenizer, coreference_embedding_model = load_tokenizer_and_embedding_model(
+            coreference_resolution_model["base_model_name"], **encoder_settings)
+    attributes_classification_model = load_ontology_classification_model() if attributes_classification else None
+    # The cache keys identify the models by a fingerprint of their weights, computed once for all files
+    mentions_detection_model_fingerprint, coreference_resolution_model_fingerprint = None, None
+    if cache_directory is not None and streaming_window_length is None:
+        mentions_detection_model_fingerprint = get_model_fingerprint(mentions_detection_model)
+        coreference_resolution_model_fingerprint = get_model_fingerprint(coreference_resolution_model)
+
+    processing_stats = []
+    for i, file_name in enumerate(unprocessed_files):
+        if verbose: print(f"[{i + 1}/{len(unprocessed_files)}] Processing: {file_name}...")
+        start_time = time.perf_counter()
+        try:
+            if streaming_window_length is None:
+                file_stats = process_file(file_name,
+                                          input_folder,
+                                          output_folder,
+                                          spacy_model,
+                                          mentions_detection_model,
+                                          coreference_resolution_model,
+                                          tokenizer, embedding_model,
+                                          spacy_max_characters_batch=spacy_max_characters_batch,
+                                          spacy_n_process=spacy_n_process,
+                                          embedding_mini_batch=embedding_mini_batch,
+                                          mentions_detection_batch=mentions_detection_batch,
+                                          coreference_resolution_batch=coreference_resolution_batch,
+                                          coreference_tokenizer=coreference_tokenizer,
+                                          coreference_embedding_model=coreference_embedding_model,
+                                          cache_directory=cache_directory,
+                                          file_format=file_format,
+                                          embeddings_dtype=embeddings_dtype,
+                                          attributes_classification_model=attributes_classification_model,
+                                          mentions_detection_model_fingerprint=mentions_detection_model_fingerprint,
+                                          coreference_resolution_model_fingerprint=coreference_resolution_model_fingerprint,
+                                          verbose=verbose)
+            else:
+                file_stats = process_file_streaming(file_name,
+                                                    input_folder,
+                                                    output_folder,
+                                                    spacy_model,
+                                                    mentions_detection_model,
+                                                    coreference_resolution_model,
+                                                    tokenizer, embedding_model,
+                                                    window_length=streaming_window_length,
+                                                    spacy_max_characters_batch=spacy_max_characters_batch,
+                                                    embedding_mini_batch=embedding_mini_batch,
+                                                    mentions_detection_batch=mentions_detection_batch,
+                                                    coreference_resolution_batch=coreference_resolution_batch,
+                                                    coreference_tokenizer=coreference_tokenizer,
+                                                    coreference_embedding_model=coreference_embedding_model,
+                                                    embeddings_dtype=embeddings_dtype,
+                                                    attributes_classification_model=attributes_classification_model,
+                                                    verbose=verbose)
+            status = "processed"
+        except Exception as e:
+            print(f"⚠️ Unexpected error processing file {file_name}: {e}")
+            traceback.print_exc()
+            file_stats = {"characters": 0, "tokens": 0, "entities": 0}
+            status = "error"
+
+        elapsed_time = time.perf_counter() - start_time
+        tokens_per_second = file_stats["tokens"] / elapsed_time if elapsed_time > 0 else 0
+        processing_stats.append({"file_name": file_name,
+                                 **file_stats,
+                                 "seconds": round(elapsed_time, 2),
+                                 "tokens_per_second": round(tokens_per_second, 1),
+                                 "status": status})
+        if verbose and status == "processed":
+            print(f"{file_name}: {file_stats['tokens']:,} tokens in {elapsed_time:.1f}s ({tokens_per_second:,.0f} tokens/s)")
+
+    processing_stats_df = pd.DataFrame(processing_stats, columns=columns)
+
+    processed_df = processing_stats_df[processing_stats_df["status"] == "processed"]
+    total_seconds = processed_df["seconds"].sum()
+    total_tokens = processed_df["tokens"].sum()
+    print(f"\nProcessed {len(processed_df):,} / {len(unprocessed_files):,} files: "
+          f"{total_tokens:,} tokens in {total_seconds:.1f}s "
+          f"({(total_tokens / total_seconds) if total_seconds > 0 else 0:,.0f} tokens/s)")
+
+    return processing_stats_df
@@ -0,0 +1,72 @@
+import random
+
+import pandas as pd
+import pytest
+
+spacy = pytest.importorskip("spacy")
+
+from propp_fr.propp_fr_generate_tokens_df import generate_tokens_df, get_paragraph_boundaries, iterate_paragraph_windows_tokens_df, shift_tokens_df
+
+# Columns set by the tokenization and the paragraph / sentence stitching. The parser outputs (lemma, POS_tag,
+# dependency_relation, syntactic_head_ID, morph) depend on the context of each parsed sample, so they can
+# differ at sample boundaries whatever the way the text is cut.
+TOKENIZATION_COLUMNS = ['paragraph_ID', 'sentence_ID', 'token_ID_within_sentence', 'token_ID_within_document',
+                        'word', 'byte_onset', 'byte_offset']
+
+SENTENCES = ["Le chat dort sur le canapé.", "Marie parle à Paul depuis la fenêtre.",
+             "Il pleut beaucoup aujourd'hui.", "Paul ne répond pas."]
+
+
+@pytest.fixture(scope="module")
+def spacy_model():
+    try:
+        return spacy.load("fr_core_news_sm")
+    except OSError:
+        pytest.skip("fr_core_news_sm is not installed")
+
+
+def get_text_with_trailing_whitespace(paragraphs_count=80, seed=0):
+    # Paragraphs ending with trailing spaces / tabs, separated by newline runs mixed with whitespace
+    rng = random.Random(seed)
+    text = ""
+    for _ in range(paragraphs_count):
+        text += " ".join(rng.choice(SENTENCES) for _ in range(rng.randint(1, 4)))
+        text += rng.choice(["", " ", "  ", "   ", " \t"])
+        text += rng.choice(["\n", "\n\n", "\r\n", "\n  \n", "\n \n\n"])
+    return text
+
+
+def test_paragraph_boundaries_cut_before_whitespace_runs():
+    text = get_text_with_trailing_whitespace()
+    boundaries = get_paragraph_boundaries(text, max_char_sentence_length=300)
+    assert boundaries[0] == 0 and boundaries[-1] == len(text)
+    assert len(boundaries) > 3
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        sample = text[start:end]
+        assert sample.strip()
+        if start > 0:
+            assert not text[start - 1].isspace() and "\n" in sample[:len(sample) - len(sample.lstrip())]
+
+
+@pytest.mark.parametrize("max_char_sentence_length", [500, 2000])
+@pytest.mark.parametrize("text", [get_text_with_trailing_whitespace(), "  \n\n \t\n   \r\n  "],
+                         ids=["trailing_whitespace", "whitespace_only"])
+def test_parallel_tokens_df_matches_sequential(spacy_model, max_char_sentence_length, text):
+    sequential_tokens_df = generate_tokens_df(text, spacy_model, max_char_sentence_length=max_char_sentence_length,
+                                              n_process=1, verbose=0)
+    parallel_tokens_df = generate_tokens_df(text, spacy_model, max_char_sentence_length=max_char_sentence_length,
+                                            n_process=2, verbose=0)
+    pd.testing.assert_frame_equal(parallel_tokens_df[TOKENIZATION_COLUMNS], sequential_tokens_df[TOKENIZATION_COLUMNS])
+
+
+@pytest.mark.parametrize("window_length", [300, 1000])
+def test_streamed_tokens_df_matches_one_shot(spacy_model, window_length):
+    # Blank lines around the cut points, so that some windows would otherwise be whitespace only
+    text = "   \n\n" + get_text_with_trailing_whitespace().replace("\n\n", "\n  \n \n\n   \n") + "  \n\n  "
+    one_shot_tokens_df = generate_tokens_df(text, spacy_model, max_char_sentence_length=len(text), verbose=0)
+    windows_tokens_dfs = [shift_tokens_df(window_tokens_df, shift) for _, window_tokens_df, shift
+                          in iterate_paragraph_windows_tokens_df(text, spacy_model, window_length=window_length, verbose=0)]
+    assert len(windows_tokens_dfs) > 1
+    streamed_tokens_df = pd.concat(windows_tokens_dfs, ignore_index=True)
+    pd.testing.assert_frame_equal(streamed_tokens_df[TOKENIZATION_COLUMNS], one_shot_tokens_df[TOKENIZATION_COLUMNS],
+                                  check_categorical=False, check_dtype=False)
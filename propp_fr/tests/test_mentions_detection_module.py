@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from propp_fr.propp_fr_mentions_detection_module import remove_overlapping_entities
+
+
+def remove_overlapping_entities_reference(all_predicted_entities):
+    # Previous O(n²) implementation, kept as the oracle of the sweep-line version
+    all_predicted_entities = all_predicted_entities.copy()
+    all_predicted_entities["overlapping_boundaries"] = False
+
+    start_tokens = all_predicted_entities["start_token"].values
+    end_tokens = all_predicted_entities["end_token"].values
+
+    n = len(all_predicted_entities)
+    overlapping_mask = np.zeros(n, dtype=bool)
+
+    for i in range(n):
+        start, end = start_tokens[i], end_tokens[i]
+        higher_ranked_mask = np.arange(n) > i
+        overlapping_mask |= (
+            higher_ranked_mask
+            & (
+                ((start_tokens < start) & (end_tokens > start) & (end_tokens < end))
+                | ((end_tokens > end) & (start_tokens > start) & (start_tokens < end))
+                | ((start_tokens == start) & (end_tokens == end))
+            )
+        )
+
+    all_predicted_entities.loc[overlapping_mask, "overlapping_boundaries"] = True
+    return all_predicted_entities[~all_predicted_entities["overlapping_boundaries"]].drop_duplicates()
+
+
+def get_random_entities_df(rng, entities_count, text_length):
+    # Short spans over a short text, so that nested, crossing and duplicate spans are all frequent
+    start_tokens = rng.integers(0, text_length, entities_count)
+    end_tokens = start_tokens + rng.integers(0, 6, entities_count)
+    entities_df = pd.DataFrame({"start_token": start_tokens,
+                                "end_token": end_tokens,
+                                "cat": rng.choice(["PER", "LOC", "FAC"], entities_count),
+                                # Few distinct confidences, so that exact duplicate rows also occur
+                                "confidence": rng.choice([0.5, 0.75, 0.9], entities_count)})
+    return entities_df.sort_values("confidence", kind="stable").reset_index(drop=True)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_remove_overlapping_entities_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(50):
+        entities_df = get_random_entities_df(rng, int(rng.integers(0, 80)), int(rng.integers(1, 40)))
+        pd.testing.assert_frame_equal(remove_overlapping_entities(entities_df),
+                                      remove_overlapping_entities_reference(entities_df))
+
+
+def test_remove_overlapping_entities_keeps_nested_and_drops_crossing():
+    entities_df = pd.DataFrame({"start_token": [0, 2, 1, 7, 7],
+                                "end_token": [4, 3, 6, 9, 9],
+                                "cat": ["PER", "PER", "LOC", "PER", "LOC"],
+                                "confidence": [0.1, 0.2, 0.3, 0.4, 0.5]})
+    kept_df = remove_overlapping_entities(entities_df)
+    # (2, 3) is nested in (0, 4), (1, 6) crosses (0, 4) and the second (7, 9) duplicates the first one's span
+    assert kept_df[["start_token", "end_token"]].values.tolist() == [[0, 4], [2, 3], [7, 9]]
+    pd.testing.assert_frame_equal(kept_df, remove_overlapping_entities_reference(entities_df))